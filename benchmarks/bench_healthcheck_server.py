@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Compare the Flask/waitress and standard library healthcheck servers.
+
+Usage:
+
+    python benchmarks/bench_healthcheck_server.py [--duration 2.0] [--output results.json]
+
+Each backend is measured in a fresh interpreter: the time to import it, the resident
+memory once it is serving, and the rate of sequential `/api/health` requests.
+
+"""
+from argparse import ArgumentParser
+from json import dump, dumps
+from platform import platform, python_version
+from socket import socket
+from subprocess import PIPE, Popen, check_output
+from sys import executable
+from time import perf_counter, sleep
+
+import requests
+
+
+BACKENDS = dict(
+    flask="microcosm_daemon.healthcheck_server",
+    stdlib="microcosm_daemon.stdlib_healthcheck_server",
+)
+
+IMPORT_TIME = """
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+"""
+
+SERVE = """
+from microcosm_daemon.heartbeat import HeartbeatTable
+from {module} import run
+table = HeartbeatTable(1)
+table.beat(0)
+run(1, 3600, "127.0.0.1", {port}, heartbeat_table=table)
+"""
+
+
+def free_port():
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_time(module, rounds=5):
+    return min(
+        float(check_output([executable, "-c", IMPORT_TIME.format(module=module)]))
+        for _ in range(rounds)
+    )
+
+
+def rss_kib(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+def wait_until_serving(url, timeout=10.0):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            requests.get(url)
+            return
+        except requests.ConnectionError:
+            sleep(0.05)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+def requests_per_sec(url, duration):
+    # one connection per request, as with Kubernetes probes
+    count, start = 0, perf_counter()
+    while perf_counter() - start < duration:
+        requests.get(url)
+        count += 1
+    return count / (perf_counter() - start)
+
+
+def measure(module, duration):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/api/health"
+    process = Popen([executable, "-c", SERVE.format(module=module, port=port)], stderr=PIPE)
+    try:
+        wait_until_serving(url)
+        return dict(
+            import_seconds=import_time(module),
+            rss_kib=rss_kib(process.pid),
+            requests_per_sec=requests_per_sec(url, duration),
+        )
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("backends", nargs="*", help=f"Backends to compare: {', '.join(BACKENDS)}")
+    args = parser.parse_args()
+
+    results = dict()
+    for name in args.backends or BACKENDS:
+        results[name] = measure(BACKENDS[name], args.duration)
+        print(dumps({name: results[name]}))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            dump(
+                dict(
+                    python=python_version(),
+                    platform=platform(),
+                    results=results,
+                ),
+                output,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the state machine loop and its policies.
+
+Usage:
+
+    python benchmarks/bench_state_machine.py [--duration 1.0] [--rounds 5] [--output results.json]
+
+Each benchmark runs for `--rounds` rounds of `--duration` seconds; the median rate (in
+operations per second) is reported so that runs can be compared.
+
+"""
+import logging
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle
+from json import dump, dumps
+from os import getpid
+from platform import platform, python_version
+from statistics import median
+from threading import Thread
+from time import perf_counter, time
+
+import requests
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.error_policy import ErrorPolicy
+from microcosm_daemon.health_reporter import HealthReporter
+from microcosm_daemon.heartbeat import HeartbeatTable, attach_heartbeat_table, claim_heartbeat_slot
+from microcosm_daemon.sleep_policy import SleepNow, SleepPolicy
+from microcosm_daemon.standby import StandByState
+from microcosm_daemon.state_machine import StateMachine
+from microcosm_daemon.state_metrics import StateMetrics
+
+
+BENCHMARKS = dict()
+
+
+def benchmark(func):
+    """
+    Register a benchmark.
+
+    A benchmark is a function that returns a callable performing one operation (or
+    `ops_per_call` operations, if the callable defines that attribute).
+
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(operation, duration, rounds):
+    ops_per_call = getattr(operation, "ops_per_call", 1)
+    rates = []
+    for _ in range(rounds):
+        iterations = 0
+        start = perf_counter()
+        while True:
+            for _ in range(100):
+                operation()
+            iterations += 100 * ops_per_call
+            elapsed = perf_counter() - start
+            if elapsed >= duration:
+                break
+        rates.append(iterations / elapsed)
+
+    return dict(
+        ops_per_sec=median(rates),
+        min_ops_per_sec=min(rates),
+        max_ops_per_sec=max(rates),
+        rounds=rounds,
+        duration=duration,
+    )
+
+
+def new_graph():
+    return create_object_graph("benchmark", testing=True)
+
+
+def noop(graph):
+    pass
+
+
+def fail(graph):
+    raise Exception("benchmark")
+
+
+def sleep_now(graph):
+    raise SleepNow()
+
+
+@benchmark
+def noop_state():
+    return StateMachine(new_graph(), noop).advance
+
+
+@benchmark
+def noop_state_batched():
+    state_machine = StateMachine(new_graph(), noop, batch_size=100)
+
+    def operation():
+        state_machine.advance()
+
+    operation.ops_per_call = state_machine.batch_size
+    return operation
+
+
+@benchmark
+def noop_state_with_metrics():
+    return StateMachine(new_graph(), noop, metrics=StateMetrics()).advance
+
+
+@benchmark
+def error_state():
+    return StateMachine(new_graph(), fail).advance
+
+
+@benchmark
+def sleep_state():
+    graph = new_graph()
+    state_machine = StateMachine(graph, sleep_now)
+    state_machine.sleep_policy.sleep = lambda sleep_timeout: None
+    return state_machine.advance
+
+
+@benchmark
+def standby_transitions():
+    graph = new_graph()
+    condition = cycle([True, False]).__next__
+    state_machine = StateMachine(graph, StandByState(noop, lambda graph: condition(), 0.0))
+    state_machine.sleep_policy.sleep = lambda sleep_timeout: None
+    return state_machine.advance
+
+
+@benchmark
+def error_policy_exit():
+    error_policy = ErrorPolicy(
+        strict=False,
+        health_report_interval=3.0,
+        health_reporter=HealthReporter(new_graph()),
+    )
+
+    def operation():
+        with error_policy:
+            pass
+
+    return operation
+
+
+@benchmark
+def sleep_policy_exit():
+    sleep_policy = SleepPolicy(default_sleep_timeout=0.0)
+    sleep_policy.sleep = lambda sleep_timeout: None
+
+    def operation():
+        with sleep_policy:
+            raise SleepNow()
+
+    return operation
+
+
+@benchmark
+def heartbeat_shared_memory():
+    health_reporter = HealthReporter(new_graph())
+    attach_heartbeat_table(HeartbeatTable(1))
+    claim_heartbeat_slot(0)
+    return health_reporter.heartbeat
+
+
+class HeartbeatHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for the healthcheck server's heartbeat endpoint.
+
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_healthcheck_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HeartbeatHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@benchmark
+def heartbeat_http_blocking():
+    server = start_healthcheck_server()
+    url = f"http://127.0.0.1:{server.server_port}/api/heartbeat"
+
+    def operation():
+        requests.post(url, json=dict(pid=getpid()), timeout=1)
+
+    return operation
+
+
+@benchmark
+def heartbeat_http_background():
+    server = start_healthcheck_server()
+    attach_heartbeat_table(None)
+    claim_heartbeat_slot(None)
+    health_reporter = HealthReporter(new_graph())
+    health_reporter.heartbeat_sender.url = f"http://127.0.0.1:{server.server_port}/api/heartbeat"
+    return health_reporter.heartbeat
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--duration", type=float, default=1.0)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run: {', '.join(BENCHMARKS)}")
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    # benchmarks exercise error handling; don't measure log formatting
+    logging.disable(logging.CRITICAL)
+
+    results = dict()
+    for name in args.names or BENCHMARKS:
+        results[name] = measure(BENCHMARKS[name](), args.duration, args.rounds)
+        print(f"{name:30} {results[name]['ops_per_sec']:>14,.0f} ops/sec")  # noqa: T201
+
+    report = dict(
+        timestamp=time(),
+        python=python_version(),
+        platform=platform(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as outfile:
+            dump(report, outfile, indent=2, sort_keys=True)
+    else:
+        print(dumps(report, sort_keys=True))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,25 @@ Expose core state machine and errors.
 
 """
 from microcosm_daemon.error_policy import ExitError, FatalError
-from microcosm_daemon.sleep_policy import SleepNow
+from microcosm_daemon.prefetch import prefetch
+from microcosm_daemon.sleep_policy import SleepNow, WaitFor
 from microcosm_daemon.state_machine import StateMachine
 
 
-__all__ = [
+__all__ = [  # noqa: F822 (AsyncStateMachine is imported lazily)
+    "AsyncStateMachine",
     "ExitError",
     "FatalError",
     "SleepNow",
     "StateMachine",
+    "WaitFor",
+    "prefetch",
 ]
+
+
+def __getattr__(name):
+    # asyncio is slow to import; only async daemons pay for it
+    if name == "AsyncStateMachine":
+        from microcosm_daemon.async_state_machine import AsyncStateMachine
+        return AsyncStateMachine
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,185 @@
+"""
+Asynchronous state machine processing.
+
+"""
+from asyncio import gather, new_event_loop
+from inspect import isawaitable
+from time import perf_counter, thread_time
+
+from microcosm_daemon.heartbeat import get_heartbeat_slot
+
+
+class AsyncStateMachine:
+    """
+    A state machine for driving daemon processing on an asyncio event loop.
+
+    States may be plain callables or coroutine functions. Several state machines may
+    share one event loop (see `run_concurrently`), given their own policies.
+
+    Given `metrics` (see `StateMetrics`), steps record per-state timings, errors and
+    sleeps; CPU time includes any other tasks that ran while a state was awaiting.
+    Workers with a heartbeat slot report the latency and state of their latest step.
+
+    Given a `profiler` (see `SamplingProfiler`), profiles may be started (by signal)
+    while the state machine runs; state machines sharing a loop also share a thread, so
+    samples are tagged with the state of the last one to start.
+
+    """
+    def __init__(
+        self,
+        graph,
+        initial_state,
+        never_reload=False,
+        error_policy=None,
+        sleep_policy=None,
+        metrics=None,
+        profiler=None,
+    ):
+        self.graph = graph
+        self.current_state = initial_state
+        self.metrics = metrics
+        self.profiler = profiler
+        self.heartbeat_slot = get_heartbeat_slot()
+        self.timed = metrics is not None or self.heartbeat_slot is not None
+        self.error_policy = graph.error_policy if error_policy is None else error_policy
+        self.sleep_policy = graph.sleep_policy if sleep_policy is None else sleep_policy
+        if self.heartbeat_slot is not None:
+            self.heartbeat_slot.watch(self.sleep_policy)
+        self.reloader = None
+        if graph.metadata.debug and not never_reload:
+            from microcosm_daemon.reloader import Reloader
+            self.reloader = Reloader()
+
+    async def step(self):
+        """
+        Take one step through the state transition.
+
+        """
+        if self.timed:
+            return await self.step_with_metrics()
+
+        next_state = None
+        async with self.error_policy:
+            async with self.sleep_policy:
+                next_state = self.current_state(self.graph)
+                if isawaitable(next_state):
+                    next_state = await next_state
+
+        if callable(next_state):
+            # advance to a new state
+            return next_state
+        else:
+            # stay in the same state
+            return self.current_state
+
+    async def step_with_metrics(self):
+        """
+        Take one step through the state transition, recording metrics.
+
+        """
+        state = self.current_state
+        next_state = None
+        error_type = None
+        wall_start, cpu_start = perf_counter(), thread_time()
+        wall_end, cpu_end = wall_start, cpu_start
+
+        try:
+            async with self.error_policy:
+                async with self.sleep_policy:
+                    try:
+                        next_state = state(self.graph)
+                        if isawaitable(next_state):
+                            next_state = await next_state
+                    except BaseException as error:
+                        error_type = type(error)
+                        raise
+                    finally:
+                        wall_end, cpu_end = perf_counter(), thread_time()
+        finally:
+            wall_time = wall_end - wall_start
+            if self.metrics is not None:
+                self.metrics.record(
+                    state,
+                    wall_time,
+                    cpu_end - cpu_start,
+                    error_type,
+                    sleep_time=perf_counter() - wall_end,
+                )
+            if self.heartbeat_slot is not None:
+                self.heartbeat_slot.observe(state, wall_time)
+
+        if callable(next_state):
+            return next_state
+        else:
+            return self.current_state
+
+    async def advance(self):
+        """
+        Advance once step.
+
+        """
+        self.current_state = await self.step()
+        return self.current_state
+
+    def should_run(self):
+        """
+        Should the state machine keep running?
+
+        """
+        return (
+            self.current_state and
+            not self.graph.signal_handler.interrupted
+        )
+
+    async def run_async(self, loop):
+        """
+        Run the state machine on an event loop.
+
+        """
+        if self.profiler is not None:
+            self.profiler.install()
+            self.profiler.watch(self)
+
+        try:
+            self.graph.signal_handler.add_to_loop(loop)
+            while self.should_run():
+                await self.advance()
+                if self.reloader:
+                    self.reloader()
+        except Exception:
+            pass
+
+    def run(self):
+        """
+        Run the state machine on a new event loop.
+
+        """
+        run_concurrently([self])
+
+
+def run_concurrently(state_machines):
+    """
+    Run state machines as concurrent tasks on a new event loop.
+
+    Once any state machine stops, the others are interrupted.
+
+    """
+    loop = new_event_loop()
+
+    async def run_task(state_machine):
+        try:
+            await state_machine.run_async(loop)
+        finally:
+            state_machine.graph.signal_handler.interrupt()
+
+    async def run_tasks():
+        await gather(*(run_task(state_machine) for state_machine in state_machines))
+
+    try:
+        if len(state_machines) == 1:
+            state_machine, = state_machines
+            loop.run_until_complete(state_machine.run_async(loop))
+        else:
+            loop.run_until_complete(run_tasks())
+    finally:
+        loop.close()
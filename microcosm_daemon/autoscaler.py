@@ -0,0 +1,95 @@
+"""
+Worker autoscaling policy.
+
+"""
+from logging import getLogger
+from math import ceil
+
+
+logger = getLogger("daemon.autoscaler")
+
+
+class Autoscaler:
+    """
+    Decide how many worker processes to run.
+
+    Workers report cumulative step and sleep counts through the heartbeat table; the
+    share of steps that ended in `SleepNow` since the last observation is the idle ratio.
+    Busy workers (low idle ratio) add a worker; idle workers retire one. An optional
+    backlog probe returning the number of pending work items can raise the target; a
+    probe that fails is logged and treated as reporting no backlog.
+
+    """
+    def __init__(
+        self,
+        min_processes,
+        max_processes,
+        scale_up_idle_ratio=0.2,
+        scale_down_idle_ratio=0.8,
+        backlog_probe=None,
+        backlog_per_process=1,
+    ):
+        self.min_processes = min_processes
+        self.max_processes = max_processes
+        self.scale_up_idle_ratio = scale_up_idle_ratio
+        self.scale_down_idle_ratio = scale_down_idle_ratio
+        self.backlog_probe = backlog_probe
+        self.backlog_per_process = backlog_per_process
+        self.last_steps = dict()
+        self.last_sleeps = dict()
+
+    def observe(self, table, slots):
+        """
+        Compute the idle ratio of the given slots since the last observation.
+
+        Returns None if no steps were taken.
+
+        """
+        steps = sleeps = 0
+        for slot in slots:
+            slot_steps, slot_sleeps = table.steps[slot], table.sleeps[slot]
+            last_steps, last_sleeps = self.last_steps.get(slot, 0), self.last_sleeps.get(slot, 0)
+            if slot_steps < last_steps:
+                # the worker in this slot was replaced
+                last_steps = last_sleeps = 0
+            steps += slot_steps - last_steps
+            sleeps += slot_sleeps - last_sleeps
+            self.last_steps[slot], self.last_sleeps[slot] = slot_steps, slot_sleeps
+
+        if not steps:
+            return None
+        return sleeps / steps
+
+    def desired_processes(self, current, idle_ratio):
+        """
+        Compute the desired number of worker processes, moving one worker at a time.
+
+        """
+        desired = current
+        if idle_ratio is not None:
+            if idle_ratio < self.scale_up_idle_ratio:
+                desired = current + 1
+            elif idle_ratio > self.scale_down_idle_ratio:
+                desired = current - 1
+
+        backlog = self.probe_backlog()
+        if backlog is not None and ceil(backlog / self.backlog_per_process) > current:
+            desired = max(desired, current + 1)
+
+        return max(self.min_processes, min(self.max_processes, desired))
+
+    def probe_backlog(self):
+        """
+        Query the backlog probe, if any.
+
+        Probe errors must not take down the supervising process.
+
+        """
+        if self.backlog_probe is None:
+            return None
+
+        try:
+            return self.backlog_probe()
+        except Exception as error:
+            logger.warning("Backlog probe failed", extra=dict(error=error))  # noqa: G200
+            return None
@@ -4,15 +4,19 @@ Base class for command-line driven asynchronous worker.
 """
 from abc import ABCMeta, abstractmethod, abstractproperty
 from argparse import ArgumentParser, Namespace
+from contextlib import nullcontext
+from copy import copy
 from os import environ
+from time import perf_counter
 
-from inflection import underscore
 from microcosm.api import create_object_graph
 from microcosm.caching import ProcessCache
 from microcosm.loaders import load_each, load_from_dict, load_from_environ
 
-from microcosm_daemon.api import StateMachine
-from microcosm_daemon.runner import ProcessRunner, SimpleRunner
+from microcosm_daemon.lazy_graph import use_lazily
+from microcosm_daemon.runner import ProcessRunner, SimpleRunner, ThreadRunner
+from microcosm_daemon.startup_profile import StartupProfile, process_uptime
+from microcosm_daemon.state_machine import StateMachine
 
 
 class Daemon:
@@ -22,6 +26,12 @@ class Daemon:
         self.parser = None
         self.args = None
         self.graph = None
+        self.startup_profile = None
+
+    def __getstate__(self):
+        # workers reuse the parsed arguments but rebuild the object graph in `initialize`;
+        # neither the graph nor the parser can be pickled
+        return dict(vars(self), parser=None, graph=None)
 
     @abstractproperty
     def name(self):
@@ -41,6 +51,8 @@ class Daemon:
         daemon should have different printable name.
 
         """
+        from inflection import underscore
+
         return underscore(self.__class__.__name__)
 
     @property
@@ -60,6 +72,18 @@ class Daemon:
             "health_reporter",
         ]
 
+    @property
+    def lazy_components(self):
+        """
+        Define object graph components that are built on first use instead of up front.
+
+        Daemons that share one graph across many entry points may defer components that
+        only some of them use. Lazy components may still be accessed once the graph is
+        locked; they are built once per process (e.g. in each worker).
+
+        """
+        return []
+
     @property
     def defaults(self):
         return {}
@@ -95,6 +119,36 @@ class Daemon:
     def initial_state(self):
         return self
 
+    @property
+    def batch_size(self):
+        """
+        Define the maximum number of state steps taken per error/sleep policy scope.
+
+        Subclasses with very fast (e.g. CPU-bound) states may override to amortize
+        per-step policy overhead.
+
+        """
+        return 1
+
+    @property
+    def batch_time_budget(self):
+        """
+        Define the maximum time (in seconds) spent on one batch of steps, if any.
+
+        """
+        return None
+
+    @property
+    def pipeline_depth(self):
+        """
+        Define how many results `@prefetch` states fetch ahead, in a background thread.
+
+        Subclasses whose states wait on I/O (e.g. queue consumers) may override so that
+        fetching overlaps with processing. Zero fetches in line with each step.
+
+        """
+        return 0
+
     @abstractmethod
     def __call__(self, graph):
         """
@@ -108,30 +162,126 @@ class Daemon:
         Run the daemon.
 
         """
+        start = perf_counter()
         parser = self.make_arg_parser()
         args = parser.parse_args()
+        self.validate_args(parser, args)
+        # workers inherit the parsed arguments rather than parsing them again
+        self.parser, self.args = parser, args
+
+        if args.profile_startup:
+            parse_time = perf_counter() - start
+            self.startup_profile = StartupProfile()
+            self.startup_profile.record("interpreter and imports", process_uptime() - parse_time)
+            self.startup_profile.record("argument parsing", parse_time)
 
         if args.processes < 1:
             parser.error("--processes must be positive")
-        elif args.processes == 1 and args.heartbeat_threshold_seconds < 0:
-            # If a heartbeat is configured, we'll run with a master-worker setup
-            # Otherwise just run one process overall
+        elif args.max_processes is not None and args.max_processes < args.processes:
+            parser.error("--max-processes must be at least --processes")
+        elif args.threads < 1:
+            parser.error("--threads must be positive")
+        elif args.threads > 1:
+            if args.processes > 1 or args.max_processes or args.heartbeat_threshold_seconds >= 0:
+                parser.error("--threads cannot be combined with --processes or heartbeats")
+            if args.supervise or args.prefork:
+                parser.error("--threads cannot be combined with --supervise or --prefork")
+            runner = ThreadRunner(self, **vars(args))
+        elif (
+            args.processes == 1 and
+            not args.max_processes and
+            not args.supervise and
+            not args.prefork and
+            args.heartbeat_threshold_seconds < 0
+        ):
+            # If a heartbeat, supervision or preforking is configured, we'll run with a
+            # master-worker setup. Otherwise just run one process overall
             runner = SimpleRunner(self)
         else:
+            if not args.supervise and self.spawns_worker_processes():
+                # pool workers are daemonic and may not have children; supervised ones may
+                args.supervise = True
             runner = ProcessRunner(self, **vars(args))
 
         runner.run()
 
+    def validate_args(self, parser, args):
+        """
+        Validate subclass-specific arguments (reporting errors through the parser).
+
+        """
+        pass
+
     def start(self, *args, **kwargs):
         """
         Start the state machine.
 
         """
         self.initialize()
+        self.start_state_machine()
+
+    def start_forked(self, *args, **kwargs):
+        """
+        Start the state machine in a worker forked from an initialized process.
+
+        The object graph is inherited (copy-on-write) rather than rebuilt.
+
+        """
+        self.after_fork(self.graph)
+        self.start_state_machine()
+
+    def autoscale_backlog(self):
+        """
+        Report the amount of pending work, if known, to the worker autoscaler.
+
+        Called in the master process when `--max-processes` is used; subclasses may
+        override to return e.g. a queue depth. Returning None relies on worker idleness.
+
+        The master initializes its own object graph for overriding subclasses (unless
+        `--prefork` already did); errors are logged and treated as None.
+
+        """
+        return None
+
+    def spawns_worker_processes(self):
+        """
+        Define whether workers start processes of their own (e.g. a process work queue).
+
+        Such daemons run their workers under a supervisor when using multiple processes.
+        Subclasses that otherwise start processes from workers should override.
+
+        """
+        if "work_queue" not in self.components:
+            return False
+
+        # only the configuration is needed; no component is built
+        graph = create_object_graph(
+            name=self.name,
+            debug=self.args.debug,
+            testing=self.args.testing,
+            import_name=self.import_name,
+            root_path=self.root_path,
+            loader=self.loader,
+        )
+        return graph.config.work_queue.processes
+
+    def after_fork(self, graph):
+        """
+        Re-create fork-unsafe resources (e.g. connections) after forking a worker.
+
+        Subclasses that use `--prefork` should override to reset such components.
+
+        """
+        pass
+
+    def start_state_machine(self):
         self.graph.logger.info(f"Starting daemon {self.name}")
 
         try:
             self.run_state_machine()
+            if "work_queue" in self.components:
+                # finish work handed off before the state machine stopped
+                self.graph.work_queue.close()
             exit(0)
         except Exception as exc:
             try:
@@ -142,14 +292,27 @@ class Daemon:
                 exit(1)
 
     def initialize(self):
-        # reprocess the arguments because some aspects of argparse are not pickleable
-        # and will fail under multiprocessing
-        self.parser = self.make_arg_parser()
-        self.args, _ = self.parser.parse_known_args()
+        if self.args is None:
+            self.parser = self.make_arg_parser()
+            self.args, _ = self.parser.parse_known_args()
+
         self.graph = self.create_object_graph(self.args)
 
+        if self.startup_profile is not None:
+            self.startup_profile.report()
+            # report once (not again in forked workers)
+            self.startup_profile = None
+
     def run_state_machine(self):
-        state_machine = StateMachine(self.graph, self.initial_state)
+        state_machine = StateMachine(
+            self.graph,
+            self.initial_state,
+            batch_size=self.batch_size,
+            batch_time_budget=self.batch_time_budget,
+            pipeline_depth=self.pipeline_depth,
+            metrics=self.graph.state_metrics if "state_metrics" in self.components else None,
+            profiler=self.graph.sampling_profiler if "sampling_profiler" in self.components else None,
+        )
         state_machine.run()
 
     def make_arg_parser(self):
@@ -164,8 +327,53 @@ class Daemon:
         flags.add_argument("--testing", action="store_true")
 
         parser.add_argument("--processes", type=int, default=1)
+        parser.add_argument(
+            "--prefork",
+            action="store_true",
+            help="Build the object graph once and fork worker processes from it",
+        )
+        parser.add_argument(
+            "--max-processes",
+            type=int,
+            default=None,
+            help="Autoscale between --processes and this many supervised worker processes",
+        )
+        parser.add_argument(
+            "--supervise",
+            action="store_true",
+            help="Restart crashed worker processes (with backoff) instead of stopping all workers",
+        )
+        parser.add_argument(
+            "--max-restarts",
+            type=int,
+            default=5,
+            help="Crashes per worker per minute before a supervised daemon gives up",
+        )
+        parser.add_argument(
+            "--drain-timeout",
+            type=float,
+            default=10.0,
+            help="Seconds to wait for worker processes to finish their current step on shutdown",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=1,
+            help="Number of state machines to run concurrently in threads of a single process",
+        )
+        parser.add_argument(
+            "--profile-startup",
+            action="store_true",
+            help="Log the time spent in each phase of startup",
+        )
         parser.add_argument("--healthcheck-host", type=str, default="0.0.0.0")
         parser.add_argument("--healthcheck-port", type=int, default=80)
+        parser.add_argument(
+            "--healthcheck-backend",
+            choices=["flask", "stdlib"],
+            default=environ.get("MICROCOSM_HEALTHCHECK_BACKEND", "flask"),
+            help="Serve health checks with Flask/waitress or with the (lighter) standard library",
+        )
         parser.add_argument(
             "--heartbeat-threshold-seconds",
             type=int,
@@ -181,21 +389,41 @@ class Daemon:
         Create (and lock) the object graph.
 
         """
-        graph = create_object_graph(
-            name=self.name,
-            debug=args.debug,
-            testing=args.testing,
-            import_name=self.import_name,
-            root_path=self.root_path,
-            cache=cache,
-            loader=load_each(loader, self.loader) if loader else self.loader,
-        )
+        with self.profile_phase("create_object_graph"):
+            graph = create_object_graph(
+                name=self.name,
+                debug=args.debug,
+                testing=args.testing,
+                import_name=self.import_name,
+                root_path=self.root_path,
+                cache=cache,
+                loader=load_each(loader, self.loader) if loader else self.loader,
+                profiler=None if self.startup_profile is None else self.startup_profile.factories,
+            )
         self.create_object_graph_components(graph)
         graph.lock()
         return graph
 
     def create_object_graph_components(self, graph):
-        graph.use(*self.components)
+        lazy_components = self.lazy_components
+        components = self.components
+        if lazy_components:
+            use_lazily(graph, lazy_components)
+            components = [component for component in components if component not in lazy_components]
+
+        if self.startup_profile is None:
+            graph.use(*components)
+            return
+
+        # components are built (with any dependencies not yet built) one at a time
+        for component in components:
+            with self.profile_phase(f"component: {component}"):
+                graph.use(component)
+
+    def profile_phase(self, phase):
+        if self.startup_profile is None:
+            return nullcontext()
+        return self.startup_profile.phase(phase)
 
     @classmethod
     def create_for_testing(cls, loader=None, cache=None, **kwargs):
@@ -213,3 +441,59 @@ class Daemon:
         daemon.args = Namespace(debug=False, testing=True, **kwargs)
         daemon.graph = daemon.create_object_graph(daemon.args, cache=cache, loader=loader)
         return daemon
+
+
+class AsyncDaemon(Daemon):
+    """
+    Base class for daemons whose states may be coroutines.
+
+    Runs the state machine on an asyncio event loop so that I/O-bound states can
+    keep many requests in flight within a single process. With `--concurrency N`,
+    N state machines run as tasks on the same loop, each with its own error and sleep
+    policies.
+
+    Steps are not batched or pipelined (`batch_size` and `pipeline_depth` are ignored):
+    each step already yields to the event loop while it awaits. Use `--concurrency`
+    rather than `--threads`.
+
+    """
+    def validate_args(self, parser, args):
+        if args.threads > 1:
+            parser.error("--threads is not supported by async daemons; use --concurrency")
+        if args.concurrency < 1:
+            parser.error("--concurrency must be positive")
+
+    def make_arg_parser(self):
+        parser = super().make_arg_parser()
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Number of state machines to run concurrently on the event loop",
+        )
+        return parser
+
+    def run_state_machine(self):
+        from microcosm_daemon.async_state_machine import AsyncStateMachine, run_concurrently
+
+        metrics = self.graph.state_metrics if "state_metrics" in self.components else None
+        profiler = self.graph.sampling_profiler if "sampling_profiler" in self.components else None
+        concurrency = getattr(self.args, "concurrency", 1)
+
+        if concurrency == 1:
+            state_machine = AsyncStateMachine(self.graph, self.initial_state, metrics=metrics, profiler=profiler)
+            state_machine.run()
+            return
+
+        run_concurrently([
+            AsyncStateMachine(
+                self.graph,
+                self.initial_state,
+                never_reload=task > 0,
+                error_policy=copy(self.graph.error_policy),
+                sleep_policy=copy(self.graph.sleep_policy),
+                metrics=metrics,
+                profiler=profiler,
+            )
+            for task in range(concurrency)
+        ])
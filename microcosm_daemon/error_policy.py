@@ -2,12 +2,16 @@
 Error handling policy.
 
 """
+from copy import copy
 from logging import getLogger
-from time import time
+from time import monotonic
 
 from microcosm.api import defaults
+from microcosm.config.types import boolean
 from microcosm.config.validation import typed
 
+from microcosm_daemon.sleep_policy import SleepPolicy
+
 
 # nagios style health codes
 HEALTH_OK = 0
@@ -34,74 +38,315 @@ class FatalError(Exception):
     pass
 
 
+class ErrorWindow:
+    """
+    Count errors over a sliding time window.
+
+    The window is divided into a fixed number of buckets so that recording and expiring
+    errors never allocates.
+
+    """
+    def __init__(self, window_seconds, buckets=10):
+        self.bucket_seconds = window_seconds / buckets
+        self.counts = [0] * buckets
+        self.total = 0
+        # the (absolute) index of the most recent bucket
+        self.current = 0
+
+    def advance(self, now):
+        """
+        Expire buckets that have fallen out of the window.
+
+        """
+        current = int(now / self.bucket_seconds)
+        if current == self.current:
+            return
+
+        if self.total:
+            size = len(self.counts)
+            for index in range(self.current + 1, min(current, self.current + size) + 1):
+                self.total -= self.counts[index % size]
+                self.counts[index % size] = 0
+        self.current = current
+
+    def record(self, now):
+        self.advance(now)
+        self.counts[self.current % len(self.counts)] += 1
+        self.total += 1
+
+    def next_expiry(self):
+        """
+        The next time at which errors may expire.
+
+        """
+        return (self.current + 1) * self.bucket_seconds
+
+
+class CircuitBreaker:
+    """
+    Stop retrying a failing state at full speed.
+
+    After `threshold` consecutive errors of the same class, the circuit opens and the
+    state machine sleeps for a backoff that starts at `min_backoff` and doubles (up to
+    `max_backoff`) every time the circuit reopens. The circuit is then half-open: any
+    error during the next `half_open_trials` steps reopens it, after which it closes.
+
+    Backoff sleeps end early when the daemon is interrupted (given `shutdown`).
+
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, min_backoff=1.0, max_backoff=30.0, half_open_trials=1, shutdown=None):
+        self.threshold = threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.half_open_trials = half_open_trials
+        self.sleep_policy = SleepPolicy(min_backoff, shutdown=shutdown)
+        self.state = CircuitBreaker.CLOSED
+        self.error_type = None
+        self.consecutive_errors = 0
+        self.trials = 0
+        self.backoff = 0.0
+
+    def __copy__(self):
+        # copies (e.g. one per thread runner lane) start closed
+        return CircuitBreaker(
+            threshold=self.threshold,
+            min_backoff=self.min_backoff,
+            max_backoff=self.max_backoff,
+            half_open_trials=self.half_open_trials,
+            shutdown=self.sleep_policy.shutdown,
+        )
+
+    def on_success(self):
+        if self.state is CircuitBreaker.CLOSED:
+            self.consecutive_errors = 0
+            return
+
+        self.trials += 1
+        if self.trials >= self.half_open_trials:
+            logger.info("Circuit closed after %s trial step(s)", self.trials)
+            self.state = CircuitBreaker.CLOSED
+            self.error_type = None
+            self.backoff = 0.0
+
+    def on_error(self, error_type):
+        """
+        Record an error, returning the backoff (in seconds) if the circuit opens.
+
+        """
+        if self.state is CircuitBreaker.HALF_OPEN:
+            return self.open(error_type)
+
+        if error_type is self.error_type:
+            self.consecutive_errors += 1
+        else:
+            self.error_type = error_type
+            self.consecutive_errors = 1
+
+        if self.consecutive_errors >= self.threshold:
+            return self.open(error_type)
+        return None
+
+    def open(self, error_type):
+        if self.backoff:
+            self.backoff = min(self.max_backoff, self.backoff * 2)
+        else:
+            self.backoff = self.min_backoff
+
+        logger.warning(
+            "Circuit opened after %s; backing off for %.1f seconds",
+            error_type.__name__,
+            self.backoff,
+        )
+        self.state = CircuitBreaker.OPEN
+        self.consecutive_errors = 0
+        self.trials = 0
+        return self.backoff
+
+    def sleep(self, backoff):
+        self.sleep_policy.sleep(backoff)
+        self.state = CircuitBreaker.HALF_OPEN
+
+    async def async_sleep(self, backoff):
+        await self.sleep_policy.async_sleep(backoff)
+        self.state = CircuitBreaker.HALF_OPEN
+
+
 class ErrorPolicy:
     """
     Handle errors from state functions.
 
+    Health reflects the number of errors in the last `error_window_seconds`: at least
+    `warn_threshold` errors is a warning and at least `error_threshold` is an error.
+
+    Steps without errors only compare the clock against the next time that health
+    could change (an error expiring) or must be reported.
+
+    Given a `circuit_breaker`, swallowed errors that keep recurring back off instead of
+    being retried immediately.
+
     """
-    def __init__(self, strict, health_report_interval, health_reporter):
+    def __init__(
+        self,
+        strict,
+        health_report_interval,
+        health_reporter,
+        error_window_seconds=60.0,
+        warn_threshold=1,
+        error_threshold=10,
+        circuit_breaker=None,
+    ):
         self.strict = strict
         self.health_report_interval = health_report_interval
+        self.warn_threshold = warn_threshold
+        self.error_threshold = error_threshold
+        self.error_window_seconds = error_window_seconds
+        self.error_window = ErrorWindow(error_window_seconds)
+        # the errors of the last step
         self.errors = []
         self.health = self.compute_health()
-        self.last_health_report_time = 0
+        self.last_health_report_time = None
+        self.next_health_check = 0.0
         self.health_reporter = health_reporter
+        self.circuit_breaker = circuit_breaker
+
+    def __copy__(self):
+        # copies (e.g. one per thread runner lane) count their own errors
+        error_policy = self.__class__.__new__(self.__class__)
+        error_policy.__dict__.update(self.__dict__)
+        error_policy.error_window = ErrorWindow(self.error_window_seconds)
+        error_policy.errors = []
+        if self.circuit_breaker is not None:
+            error_policy.circuit_breaker = copy(self.circuit_breaker)
+        return error_policy
 
     def compute_health(self):
         """
         Compute the current daemon health.
 
         """
-        return HEALTH_OK if not self.errors else HEALTH_ERROR
+        if self.error_window.total >= self.error_threshold:
+            return HEALTH_ERROR
+        if self.error_window.total >= self.warn_threshold:
+            return HEALTH_WARN
+        return HEALTH_OK
 
-    def should_report_health(self, new_health):
+    def should_report_health(self, new_health, now=None):
         """
         Should health be reported?
 
         True if health status changes or enough time elapses.
 
         """
-        if self.health != new_health:
+        if self.health != new_health or self.last_health_report_time is None:
             return True
-        return self.last_health_report_time + self.health_report_interval < time()
+        if now is None:
+            now = monotonic()
+        return self.last_health_report_time + self.health_report_interval < now
 
-    def report_health(self, new_health):
+    def report_health(self, new_health, now=None):
         """
         Report health information.
 
         """
-        self.last_health_report_time = time()
+        self.last_health_report_time = monotonic() if now is None else now
         self.health_reporter(new_health, self.health, self.errors)
 
-    def maybe_report_health(self):
+    def maybe_report_health(self, now=None):
         """
         Conditionally report health information.
 
         """
+        if now is None:
+            now = monotonic()
+
+        self.error_window.advance(now)
         new_health = self.compute_health()
-        if self.should_report_health(new_health):
-            self.report_health(new_health)
+        if self.should_report_health(new_health, now):
+            self.report_health(new_health, now)
         self.health = new_health
 
+        self.next_health_check = self.last_health_report_time + self.health_report_interval
+        if self.error_window.total:
+            self.next_health_check = min(self.next_health_check, self.error_window.next_expiry())
+
+    def on_exit(self, type, value):
+        """
+        Record the outcome of a step, returning a circuit breaker backoff (if any).
+
+        """
+        now = monotonic()
+        if value is None:
+            if self.errors:
+                self.errors = []
+            if now >= self.next_health_check:
+                self.maybe_report_health(now)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.on_success()
+            return None
+
+        self.errors = [value]
+        self.error_window.record(now)
+        self.health_reporter.log_error(value)
+        self.maybe_report_health(now)
+        if self.circuit_breaker is None or not self.should_swallow(type):
+            return None
+        return self.circuit_breaker.on_error(type)
+
+    def should_swallow(self, type):
+        return not self.strict and type not in (ExitError, FatalError)
+
     def __enter__(self):
-        # reset errors on every iteration
-        self.errors = []
         return self
 
     def __exit__(self, type, value, traceback):
-        if value:
-            self.errors.append(value)
-        self.maybe_report_health()
-        return not self.strict and type not in (ExitError, FatalError)
+        backoff = self.on_exit(type, value)
+        if backoff:
+            self.circuit_breaker.sleep(backoff)
+        return self.should_swallow(type)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, type, value, traceback):
+        backoff = self.on_exit(type, value)
+        if backoff:
+            await self.circuit_breaker.async_sleep(backoff)
+        return self.should_swallow(type)
 
 
 @defaults(
     strict=False,
     health_report_interval=typed(float, 3.0),
+    error_window_seconds=typed(float, 60.0),
+    warn_threshold=typed(int, 1),
+    error_threshold=typed(int, 10),
+    circuit_breaker=typed(boolean, False),
+    circuit_breaker_threshold=typed(int, 5),
+    circuit_breaker_min_backoff=typed(float, 1.0),
+    circuit_breaker_max_backoff=typed(float, 30.0),
+    circuit_breaker_half_open_trials=typed(int, 1),
 )
 def configure_error_policy(graph):
+    circuit_breaker = None
+    if graph.config.error_policy.circuit_breaker:
+        circuit_breaker = CircuitBreaker(
+            threshold=graph.config.error_policy.circuit_breaker_threshold,
+            min_backoff=graph.config.error_policy.circuit_breaker_min_backoff,
+            max_backoff=graph.config.error_policy.circuit_breaker_max_backoff,
+            half_open_trials=graph.config.error_policy.circuit_breaker_half_open_trials,
+            shutdown=graph.signal_handler.shutdown,
+        )
+
     return ErrorPolicy(
         strict=graph.config.error_policy.strict,
         health_report_interval=graph.config.error_policy.health_report_interval,
         health_reporter=graph.health_reporter,
+        error_window_seconds=graph.config.error_policy.error_window_seconds,
+        warn_threshold=graph.config.error_policy.warn_threshold,
+        error_threshold=graph.config.error_policy.error_threshold,
+        circuit_breaker=circuit_breaker,
     )
@@ -1,9 +1,13 @@
 import os
 from logging import getLogger
+from re import compile as re_compile
+from threading import Condition, Lock, Thread
+from time import monotonic
 
 from microcosm.api import defaults, typed
 
 from microcosm_daemon.error_policy import ExitError
+from microcosm_daemon.heartbeat import get_heartbeat_slot, get_worker_slot
 
 
 try:
@@ -14,12 +18,172 @@ except ImportError:
 
 logger = getLogger("daemon.health_reporter")
 
+# mask numbers (ids, counts, ports) so that they do not defeat error grouping
+NUMBERS = re_compile(r"\d+")
+
+
+class HeartbeatSender:
+    """
+    Post heartbeats to the healthcheck server from a background thread.
+
+    Each process has its own sender, with at most one pending heartbeat: a heartbeat
+    sent while another is pending replaces it, so that only the latest is ever posted
+    and callers never block on health I/O.
+
+    """
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.pending = None
+        self.condition = Condition()
+        self.start_lock = Lock()
+        self.session = None
+        self.thread = None
+        self.owner_pid = None
+        self.sent = 0
+        self.coalesced = 0
+
+    def send(self, pid, slot=None):
+        """
+        Enqueue a heartbeat without waiting for it to be delivered.
+
+        """
+        self.ensure_started()
+
+        with self.condition:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = dict(pid=pid) if slot is None else dict(pid=pid, slot=slot)
+            self.condition.notify()
+
+    def ensure_started(self):
+        """
+        Start the sender thread (again, if this process was forked).
+
+        """
+        if self.owner_pid == os.getpid():
+            return
+
+        # thread runner lanes report health concurrently; start exactly one sender
+        with self.start_lock:
+            if self.owner_pid == os.getpid():
+                return
+
+            self.condition = Condition()
+            self.pending = None
+            self.session = requests.Session()
+            self.thread = Thread(target=self.run, name="heartbeat-sender", daemon=True)
+            self.thread.start()
+            self.owner_pid = os.getpid()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                payload, self.pending = self.pending, None
+
+            self.post(payload)
+
+    def post(self, payload):
+        try:
+            self.session.post(self.url, json=payload, timeout=self.timeout)
+            self.sent += 1
+        except Exception as err:
+            logger.debug("Failed to send heartbeat", extra=dict(error=err))  # noqa: G200
+
+
+class ErrorLog:
+    """
+    Log state errors with at most one traceback per fingerprint per interval.
+
+    Errors are fingerprinted by type and message. Repeats within an interval are only
+    counted; once the interval elapses, a summary with the counts is logged. At most
+    `max_fingerprints` distinct errors are tracked per interval; the rest are counted
+    together.
+
+    Thread runner lanes share the log, so its state is guarded by a lock (but logging
+    happens outside of it).
+
+    """
+    OTHER = "Other errors"
+
+    def __init__(self, interval, max_fingerprints=100):
+        self.interval = interval
+        self.max_fingerprints = max_fingerprints
+        self.lock = Lock()
+        # fingerprint -> repeats in the current interval
+        self.repeats = dict()
+        self.next_summary_time = None
+
+    def fingerprint(self, error):
+        message = NUMBERS.sub("N", str(error))[:200]
+        return f"{type(error).__qualname__}: {message}"
+
+    def log(self, error, now=None):
+        if now is None:
+            now = monotonic()
+        self.maybe_summarize(now)
+
+        fingerprint = self.fingerprint(error)
+        with self.lock:
+            repeats = self.repeats.get(fingerprint)
+            if repeats is not None:
+                self.repeats[fingerprint] = repeats + 1
+                return
+            if len(self.repeats) >= self.max_fingerprints:
+                self.repeats[ErrorLog.OTHER] = self.repeats.get(ErrorLog.OTHER, 0) + 1
+                return
+            self.repeats[fingerprint] = 0
+
+        # the error need not be the exception being handled, so is passed explicitly
+        logger.exception(  # noqa: G202
+            "Caught error during state evaluation",
+            exc_info=error,
+            extra=dict(error=error),
+        )
+
+    def maybe_summarize(self, now=None):
+        """
+        Log a summary of repeated errors once the interval elapses.
+
+        """
+        if now is None:
+            now = monotonic()
+
+        with self.lock:
+            if self.next_summary_time is None:
+                self.next_summary_time = now + self.interval
+                return
+            if now < self.next_summary_time:
+                return
+            self.next_summary_time = now + self.interval
+            repeats, self.repeats = self.repeats, dict()
+
+        for fingerprint, count in repeats.items():
+            if count:
+                logger.warning(
+                    "Suppressed %s repeated error(s) during state evaluation: %s",
+                    count,
+                    fingerprint,
+                    extra=dict(fingerprint=fingerprint, repeats=count),
+                )
+
 
 class HealthReporter:
     def __init__(self, graph):
+        self.graph = graph
         self.healthcheck_server_host = graph.config.health_reporter.healthcheck_server_host
         self.healthcheck_server_port = graph.config.health_reporter.healthcheck_server_port
         self.heartbeat_timeout = graph.config.health_reporter.heartbeat_timeout
+        self.heartbeat_sender = HeartbeatSender(
+            url=f"{self.healthcheck_server_host}:{self.healthcheck_server_port}/api/heartbeat",
+            timeout=self.heartbeat_timeout,
+        )
+        self.error_log = ErrorLog(
+            interval=graph.config.health_reporter.error_log_interval,
+            max_fingerprints=graph.config.health_reporter.error_log_max_fingerprints,
+        )
 
     def __call__(self, health, prev_health, errors):
         self.heartbeat()
@@ -31,33 +195,36 @@ class HealthReporter:
         else:
             logger.debug(message)
 
-        for error in errors:
-            if isinstance(error, ExitError):
-                continue
+        # errors are logged as they happen (see `log_error`); summarize repeats even
+        # once errors stop
+        self.error_log.maybe_summarize()
 
-            logger.exception(
-                "Caught error during state evaluation",
-                extra=dict(error=error),
-            )
+    def log_error(self, error):
+        if isinstance(error, ExitError):
+            return
+
+        self.error_log.log(error)
 
     def heartbeat(self):
+        heartbeat_slot = get_heartbeat_slot()
+        if heartbeat_slot is not None:
+            # prefer the shared-memory table allocated by the process runner; steps and
+            # sleeps are summed over the (possibly copied) sleep policies in use
+            heartbeat_slot()
+            return
+
         if requests is None:
             return
 
-        try:
-            requests.post(
-                f"{self.healthcheck_server_host}:{self.healthcheck_server_port}/api/heartbeat",
-                json={"pid": os.getpid()},
-                timeout=self.heartbeat_timeout,
-            )
-        except Exception as err:
-            logger.debug("Failed to send heartbeat", extra=dict(error=err))  # noqa: G200
+        self.heartbeat_sender.send(os.getpid(), get_worker_slot())
 
 
 @defaults(
     healthcheck_server_host="http://localhost",
     healthcheck_server_port=typed(int, default_value=80),
     heartbeat_timeout=typed(int, 1),
+    error_log_interval=typed(float, 60.0),
+    error_log_max_fingerprints=typed(int, 100),
 )
 def configure_health_reporter(graph):
     return HealthReporter(graph)
@@ -1,48 +1,42 @@
 from logging import getLogger
-from time import time
+from typing import Optional
 
 from flask import Flask, jsonify, request
 from waitress import serve
 
+from microcosm_daemon.heartbeat import HeartbeatTable
+from microcosm_daemon.sampling_profiler import PROFILE_SIGNAL
+from microcosm_daemon.worker_registry import WorkerRegistry
 
-def now():
-    return int(time())
 
-
-def create_app(processes: int, heartbeat_threshold_seconds: int):
+def create_app(
+    processes: int,
+    heartbeat_threshold_seconds: int,
+    heartbeat_table: Optional[HeartbeatTable] = None,
+    registry: Optional[WorkerRegistry] = None,
+):
     logger = getLogger("daemon.healthcheck_server")
     healthcheck_app = Flask(__name__)
-    heartbeats: dict[str, int] = dict()
+    if registry is None:
+        registry = WorkerRegistry(processes, heartbeat_threshold_seconds, heartbeat_table)
 
     @healthcheck_app.route("/api/health")
     def healthcheck():
-        if not heartbeats:
-            logger.warning("Daemon has no heartbeat. Healthcheck status: UNHEALTHY")
-            return {}, 500
+        body, status = registry.health()
+        return jsonify(body), status
 
-        ts = now()
-        last_heartbeats = {
-            str(pid): ts - last_ts
-            for pid, last_ts in heartbeats.items()
-        }
-        status = (
-            200
-            if (
-                max(last_heartbeats.values()) <= heartbeat_threshold_seconds and
-                len(last_heartbeats) == processes
-            )
-            else 500
+    @healthcheck_app.route("/api/workers")
+    def workers():
+        return jsonify(
+            workers=registry.workers(),
         )
 
-        if status != 200:
-            logger.warning(
-                "Healthcheck heartbeat status: UNHEALTHY.",
-                extra=dict(heartbeat_values=heartbeats)
-            )
-        logger.debug("Healthcheck heartbeat status: HEALTHY")
-        return jsonify(
-            heartbeats=last_heartbeats,
-        ), status
+    @healthcheck_app.route("/api/workers/<int:slot>/profile", methods=["POST"])
+    def profile_worker(slot):
+        # workers with a sampling profiler start a profile; others ignore the signal
+        if not registry.signal_worker(slot, PROFILE_SIGNAL):
+            return {}, 404
+        return {}, 202
 
     @healthcheck_app.route("/api/heartbeat", methods=["POST"])
     def worker_status():
@@ -56,7 +50,10 @@ def create_app(processes: int, heartbeat_threshold_seconds: int):
                 "Received heartbeat from {pid}",
                 extra=dict(pid=pid),
             )
-            heartbeats[pid] = now()
+            registry.record(
+                pid,
+                slot=req_data.get("slot"),
+            )
             return {}, 201
 
     return healthcheck_app
@@ -67,10 +64,11 @@ def run(
     heartbeat_threshold_seconds: int,
     healthcheck_host: str,
     healthcheck_port: int,
+    heartbeat_table: Optional[HeartbeatTable] = None,
     **kwargs,
 ):
     serve(
-        create_app(processes, heartbeat_threshold_seconds),
+        create_app(processes, heartbeat_threshold_seconds, heartbeat_table),
         host=healthcheck_host,
         port=healthcheck_port,
     )
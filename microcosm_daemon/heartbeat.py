@@ -0,0 +1,203 @@
+"""
+Shared-memory heartbeat transport.
+
+The master process allocates one slot per worker; each worker writes its pid and a
+monotonic timestamp into its own slot and the healthcheck server reads the table
+directly, avoiding an HTTP round-trip per health report.
+
+"""
+from os import getpid
+from time import monotonic
+
+
+# bytes reserved per slot for the name of the worker's current state
+STATE_NAME_LENGTH = 64
+
+
+class HeartbeatTable:
+    """
+    A fixed-size table of worker heartbeats backed by shared memory.
+
+    Each slot has a single writer, so no locking is required. Besides liveness, each
+    slot carries the worker's cumulative step and sleep counts (used for autoscaling)
+    and the latency and name of its last step (readers may see a torn update of these).
+
+    """
+    def __init__(self, size):
+        # shared ctypes are slow to import; only supervising processes need them
+        from multiprocessing.sharedctypes import RawArray
+
+        self.size = size
+        self.pids = RawArray("l", size)
+        self.timestamps = RawArray("d", size)
+        self.steps = RawArray("l", size)
+        self.sleeps = RawArray("l", size)
+        self.latencies = RawArray("d", size)
+        self.state_names = RawArray("c", size * STATE_NAME_LENGTH)
+
+    def beat(self, slot, pid=None, steps=0, sleeps=0, latency=0.0, state=""):
+        """
+        Record a heartbeat for a slot.
+
+        """
+        self.pids[slot] = pid or getpid()
+        self.steps[slot] = steps
+        self.sleeps[slot] = sleeps
+        self.latencies[slot] = latency
+        start = slot * STATE_NAME_LENGTH
+        self.state_names[start:start + STATE_NAME_LENGTH] = (
+            state.encode("utf-8", "replace")[:STATE_NAME_LENGTH].ljust(STATE_NAME_LENGTH, b"\0")
+        )
+        self.timestamps[slot] = monotonic()
+
+    def clear(self, slot):
+        """
+        Forget a slot (e.g. once its worker has been retired).
+
+        """
+        self.pids[slot] = 0
+        self.timestamps[slot] = 0.0
+        self.steps[slot] = 0
+        self.sleeps[slot] = 0
+        self.latencies[slot] = 0.0
+        start = slot * STATE_NAME_LENGTH
+        self.state_names[start:start + STATE_NAME_LENGTH] = bytes(STATE_NAME_LENGTH)
+
+    def state_name(self, slot):
+        start = slot * STATE_NAME_LENGTH
+        return self.state_names[start:start + STATE_NAME_LENGTH].rstrip(b"\0").decode("utf-8", "replace")
+
+    def workers(self):
+        """
+        Describe the worker in each written slot.
+
+        """
+        now = monotonic()
+        return [
+            dict(
+                slot=slot,
+                pid=self.pids[slot],
+                age=now - self.timestamps[slot],
+                steps=self.steps[slot],
+                sleeps=self.sleeps[slot],
+                latency=self.latencies[slot],
+                state=self.state_name(slot),
+            )
+            for slot in range(self.size)
+            if self.pids[slot]
+        ]
+
+    def ages(self):
+        """
+        Compute the age (in seconds) of each recorded heartbeat, keyed by pid.
+
+        Slots that have never been written are omitted.
+
+        """
+        now = monotonic()
+        return {
+            pid: now - timestamp
+            for pid, timestamp in zip(self.pids, self.timestamps)
+            if pid
+        }
+
+
+def state_name(state):
+    """
+    Name a state, as wrapped by any wrapping state (that sets `__wrapped__`).
+
+    """
+    state = getattr(state, "__wrapped__", state)
+    return getattr(state, "__qualname__", None) or str(state)
+
+
+class HeartbeatSlot:
+    """
+    A worker's view of its own slot in a heartbeat table.
+
+    The state machine observes each step; only heartbeats write to shared memory.
+
+    Heartbeats report the steps and sleeps counted by the sleep policies of this worker's
+    state machines (e.g. one per task of an `AsyncDaemon` with `--concurrency`), unless
+    given explicitly.
+
+    """
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
+        self.state = None
+        self.latency = 0.0
+        self.sleep_policies = []
+
+    def observe(self, state, latency):
+        self.state = state
+        self.latency = latency
+
+    def watch(self, sleep_policy):
+        """
+        Count a state machine's sleep policy towards this worker's steps and sleeps.
+
+        """
+        if not any(watched is sleep_policy for watched in self.sleep_policies):
+            self.sleep_policies.append(sleep_policy)
+
+    def __call__(self, steps=None, sleeps=None):
+        if steps is None:
+            steps = sum(sleep_policy.steps for sleep_policy in self.sleep_policies)
+        if sleeps is None:
+            sleeps = sum(sleep_policy.sleeps for sleep_policy in self.sleep_policies)
+        self.table.beat(
+            self.slot,
+            steps=steps,
+            sleeps=sleeps,
+            latency=self.latency,
+            state="" if self.state is None else state_name(self.state),
+        )
+
+
+# the heartbeat table inherited by this (worker) process, if any
+_heartbeat_table = None
+# this worker's slot in the heartbeat table, if any
+_heartbeat_slot = None
+# this worker's slot number, if run by a process runner
+_worker_slot = None
+
+
+def attach_heartbeat_table(table):
+    """
+    Attach a heartbeat table to the current process.
+
+    Intended to be used as a process pool initializer.
+
+    """
+    global _heartbeat_table
+    _heartbeat_table = table
+
+
+def claim_heartbeat_slot(slot):
+    """
+    Claim a slot in the attached heartbeat table for the current process.
+
+    """
+    global _heartbeat_slot, _worker_slot
+    _worker_slot = slot
+    if _heartbeat_table is None:
+        _heartbeat_slot = None
+    else:
+        _heartbeat_slot = HeartbeatSlot(_heartbeat_table, slot)
+
+
+def get_heartbeat_slot():
+    """
+    Return the current process's heartbeat slot, if any.
+
+    """
+    return _heartbeat_slot
+
+
+def get_worker_slot():
+    """
+    Return the current process's worker slot number, if any.
+
+    """
+    return _worker_slot
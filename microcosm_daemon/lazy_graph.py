@@ -0,0 +1,55 @@
+"""
+Lazily built components for locked object graphs.
+
+"""
+from threading import RLock, local
+
+from microcosm.constants import RESERVED
+from microcosm.object_graph import ObjectGraph
+
+
+class LazyObjectGraph(ObjectGraph):
+    """
+    An object graph that builds some components on first access, even once locked.
+
+    Components that a lazy component's factory uses are built along with it, if needed.
+    Lazy components are built under a lock, so that threads share a single instance.
+
+    """
+    def __getattr__(self, key):
+        try:
+            component = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            if component is not RESERVED:
+                return component
+
+        if key not in self._lazy_components and not getattr(self._lazy_building, "active", False):
+            return super().__getattr__(key)
+
+        with self._lazy_lock:
+            if key in self._cache or not self._locked:
+                # built (or being built by this thread) already, or not yet locked
+                return super().__getattr__(key)
+
+            active = getattr(self._lazy_building, "active", False)
+            self._lazy_building.active = True
+            try:
+                return self._resolve_key(key)
+            finally:
+                self._lazy_building.active = active
+
+    __getitem__ = __getattr__
+
+
+def use_lazily(graph, components):
+    """
+    Build the given components of a (to be locked) graph on first access.
+
+    """
+    graph.__class__ = LazyObjectGraph
+    graph._lazy_components = frozenset(components)
+    graph._lazy_lock = RLock()
+    graph._lazy_building = local()
+    return graph
@@ -0,0 +1,125 @@
+"""
+Prefetching states.
+
+"""
+from functools import update_wrapper
+from queue import Empty, Queue
+from threading import Event, Semaphore, Thread
+
+from microcosm_daemon.sleep_policy import SleepNow, WaitFor
+from microcosm_daemon.wake_up import WakeUpPipe
+
+
+def prefetch(fetch):
+    """
+    Declare a state that processes the result of `fetch(graph)`:
+
+        def fetch_batch(graph):
+            return graph.consumer.fetch()
+
+        @prefetch(fetch_batch)
+        def process_batch(graph, batch):
+            ...
+
+    By default, the state fetches and then processes. A state machine with a
+    `pipeline_depth` instead fetches up to that many results ahead in a background
+    thread, so that waiting for the next result overlaps with processing this one.
+
+    """
+    def decorator(func):
+        return PrefetchingState(func, fetch)
+    return decorator
+
+
+class PrefetchingState:
+    """
+    A state that processes a fetched result.
+
+    """
+    def __init__(self, func, fetch):
+        self.func = func
+        self.fetch = fetch
+        # sets `__wrapped__` too, so that metrics are recorded for the wrapped state
+        update_wrapper(self, func)
+
+    def __call__(self, graph):
+        return self.func(graph, self.fetch(graph))
+
+
+class Pipeline:
+    """
+    Run a prefetching state's fetches ahead of the state, in a background thread.
+
+    Up to `depth` results are fetched ahead. When none is ready, the state raises
+    `WaitFor` and so sleeps until one is. Errors raised while fetching are raised by the
+    state instead (and so handled by the error policy); a fetch that raises `SleepNow`
+    is retried after its sleep timeout (or the sleep policy's default).
+
+    Fetches run concurrently with (any) states, so must not share unsafe resources
+    with them. Results not yet processed when the pipeline stops are discarded.
+
+    """
+    def __init__(self, state, graph, depth, default_sleep_timeout):
+        self.state = state
+        self.graph = graph
+        self.default_sleep_timeout = default_sleep_timeout
+        self.results = Queue()
+        # fetches may only start while fewer than `depth` results are ahead
+        self.slots = Semaphore(depth)
+        # set whenever a result is ready, to end sleeps early
+        self.ready = WakeUpPipe()
+        self.stopped = Event()
+        self.thread = None
+        self.__wrapped__ = state.func
+
+    def __str__(self):
+        return str(self.state)
+
+    def start(self):
+        self.thread = Thread(
+            target=self.run,
+            name=f"prefetch-{self.state.__qualname__}",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        # unblock a fetch waiting for room
+        self.slots.release()
+
+    def run(self):
+        while True:
+            self.slots.acquire()
+            if self.stopped.is_set():
+                return
+
+            try:
+                result = (self.state.fetch(self.graph), None)
+            except SleepNow as sleep_now:
+                self.slots.release()
+                self.stopped.wait(sleep_now.sleep_timeout or self.default_sleep_timeout)
+                continue
+            except Exception as error:
+                result = (None, error)
+
+            self.results.put(result)
+            self.ready.set()
+
+    def __call__(self, graph):
+        if self.thread is None:
+            self.start()
+
+        try:
+            fetched, error = self.results.get_nowait()
+        except Empty:
+            self.ready.clear()
+            # a result may have been fetched before the wake-up pipe was cleared
+            if self.results.empty():
+                raise WaitFor(self.ready)
+            fetched, error = self.results.get_nowait()
+
+        self.slots.release()
+        if error is not None:
+            raise error
+        return self.state.func(graph, fetched)
@@ -6,7 +6,23 @@ Cribbed in part from: https://github.com/pallets/werkzeug/blob/master/werkzeug/_
 """
 import os
 import sys
+from ctypes import CDLL, get_errno
 from logging import getLogger
+from select import select
+from struct import calcsize, unpack_from
+from sysconfig import get_paths
+from threading import Thread
+from time import sleep
+
+
+# inotify(7) flags and events
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = "iIII"
 
 
 def _iter_module_files():
@@ -33,37 +49,163 @@ def _iter_module_files():
                 yield filename
 
 
-class Reloader:
+def _library_paths():
+    """
+    Directories of installed (non-user) code: the standard library and site-packages.
+
+    """
+    paths = get_paths()
+    return tuple(sorted({
+        os.path.join(os.path.realpath(paths[name]), "")
+        for name in ("stdlib", "platstdlib", "purelib", "platlib")
+        if name in paths
+    }))
+
+
+def _iter_user_files(library_paths):
+    """
+    Iterate over module files that are not part of installed libraries.
+
     """
-    Checks modification times for Python modules and reloads execution.
+    for filename in _iter_module_files():
+        if not os.path.realpath(filename).startswith(library_paths):
+            yield filename
+
+
+class PollingWatcher:
+    """
+    Detect changes by comparing modification times.
 
     """
     def __init__(self):
         self.mtimes = {}
 
-    @property
-    def changed(self):
-        """
-        Have any module files changed?
-'
-        """
-        for filename in _iter_module_files():
+    def add(self, filenames):
+        for filename in filenames:
+            if filename in self.mtimes:
+                continue
             try:
-                mtime = os.stat(filename).st_mtime
+                self.mtimes[filename] = os.stat(filename).st_mtime
             except OSError:
                 continue
 
-            old_time = self.mtimes.get(filename)
-            if old_time is None:
-                self.mtimes[filename] = mtime
+    def wait(self, timeout):
+        sleep(timeout)
+        for filename, old_time in self.mtimes.items():
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
                 continue
-            elif mtime > old_time:
+            if mtime > old_time:
                 getLogger().debug("Found code change for: {}".format(
                     filename,
                 ))
                 return True
         return False
 
+
+class InotifyWatcher:
+    """
+    Detect changes with inotify, watching the directories of the given files.
+
+    """
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.directories = set()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), "inotify_init1 failed")
+
+    @classmethod
+    def create(cls):
+        """
+        Create an inotify watcher, if inotify is available.
+
+        """
+        try:
+            return cls(CDLL(None, use_errno=True))
+        except (AttributeError, OSError):
+            return None
+
+    def add(self, filenames):
+        for filename in filenames:
+            directory = os.path.dirname(filename)
+            if directory in self.directories:
+                continue
+            self.directories.add(directory)
+            self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+
+    def wait(self, timeout):
+        readable, _, _ = select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        changed = False
+        try:
+            while True:
+                buffer = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(buffer):
+                    _, _, _, length = unpack_from(INOTIFY_EVENT, buffer, offset)
+                    offset += calcsize(INOTIFY_EVENT)
+                    name = buffer[offset:offset + length].rstrip(b"\0")
+                    offset += length
+                    if name.endswith(b".py"):
+                        getLogger().debug("Found code change for: {}".format(
+                            os.fsdecode(name),
+                        ))
+                        changed = True
+        except BlockingIOError:
+            pass
+        return changed
+
+
+class Reloader:
+    """
+    Watches user code (not the standard library or site-packages) and reloads execution.
+
+    Files are watched from a background thread, using inotify where available and
+    polling modification times every `interval` seconds otherwise, so that checking for
+    changes after each step only reads a flag.
+
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.library_paths = _library_paths()
+        self.module_count = 0
+        self.has_changed = False
+        self.watcher = None
+        self.thread = None
+
+    @property
+    def changed(self):
+        """
+        Have any module files changed?
+
+        """
+        return self.has_changed
+
+    def start(self):
+        self.watcher = InotifyWatcher.create() or PollingWatcher()
+        self.watch_new_modules()
+        self.thread = Thread(target=self.watch, name="reloader", daemon=True)
+        self.thread.start()
+
+    def watch_new_modules(self):
+        # modules may be imported lazily; only rescan when there are new ones
+        if len(sys.modules) != self.module_count:
+            self.module_count = len(sys.modules)
+            self.watcher.add(_iter_user_files(self.library_paths))
+
+    def watch(self):
+        while not self.has_changed:
+            if self.watcher.wait(self.interval):
+                self.has_changed = True
+            else:
+                self.watch_new_modules()
+
     def reexecute(self):
         """
         Re-execute the current program.
@@ -76,7 +218,8 @@ class Reloader:
         os.execve(sys.executable, [sys.executable] + sys.argv, os.environ)
 
     def __call__(self):
-        getLogger().debug("Checking for code changes.")
-        if self.changed:
+        if self.thread is None:
+            self.start()
+        if self.has_changed:
             getLogger().info("Detected code changes.")
             self.reexecute()
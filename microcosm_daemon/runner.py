@@ -2,9 +2,24 @@
 Execution abstraction.
 
 """
+from collections import defaultdict, deque
+from copy import copy
 from logging import getLogger
-from multiprocessing import Pool
-from signal import SIGINT, SIGTERM, signal
+from multiprocessing import active_children, get_context
+from os import getpid, kill
+from signal import (
+    SIG_IGN,
+    SIGINT,
+    SIGTERM,
+    signal,
+)
+from threading import Thread
+from time import monotonic, sleep
+
+from microcosm_daemon.error_policy import ExitError, FatalError
+from microcosm_daemon.heartbeat import HeartbeatTable, attach_heartbeat_table, claim_heartbeat_slot
+from microcosm_daemon.sampling_profiler import PROFILE_SIGNAL
+from microcosm_daemon.state_machine import StateMachine
 
 
 logger = getLogger("daemon.process_runner")
@@ -25,70 +40,541 @@ class SimpleRunner:
         self.target.start(*self.args, **self.kwargs)
 
 
+class ThreadRunner:
+    """
+    Run several independent state machines ("lanes") in threads of the current process.
+
+    Lanes share the (locked) object graph but each has its own error and sleep policy,
+    so that one lane's errors and sleeps do not affect the others.
+
+    """
+
+    def __init__(self, target, threads, *args, **kwargs):
+        self.threads = threads
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        self.target.initialize()
+        graph = self.target.graph
+        logger.info("Starting daemon %s with %s threads", self.target.name, self.threads)
+
+        # signal handlers may only be installed from the main thread
+        if "sampling_profiler" in self.target.components:
+            graph.sampling_profiler.install()
+
+        with graph.signal_handler:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                lanes = [
+                    executor.submit(self.run_lane, graph, lane)
+                    for lane in range(self.threads)
+                ]
+                wait(lanes)
+
+        exit(0)
+
+    def run_lane(self, graph, lane):
+        state_machine = StateMachine(
+            graph,
+            self.target.initial_state,
+            never_reload=lane > 0,
+            error_policy=copy(graph.error_policy),
+            sleep_policy=copy(graph.sleep_policy),
+            batch_size=self.target.batch_size,
+            batch_time_budget=self.target.batch_time_budget,
+            pipeline_depth=self.target.pipeline_depth,
+            metrics=graph.state_metrics if "state_metrics" in self.target.components else None,
+            profiler=graph.sampling_profiler if "sampling_profiler" in self.target.components else None,
+        )
+        try:
+            state_machine.run_loop()
+        except (ExitError, FatalError):
+            # the state machine was told to exit (see `StateMachine.run`)
+            pass
+        except Exception as error:
+            logger.error("Unexpected error while running thread lane", extra=dict(lane=lane, error=error))  # noqa: G200
+        finally:
+            # stop the other lanes once any lane exits
+            graph.signal_handler.interrupt()
+
+
 def _start(target, *args, **kwargs):
     target.start(*args, **kwargs)
 
 
+def _start_worker(heartbeat_slot, target, *args, **kwargs):
+    claim_heartbeat_slot(heartbeat_slot)
+    _start(target, *args, **kwargs)
+
+
+# the initialized target inherited by forked workers (in prefork mode)
+_prefork_target = None
+
+
+def _start_preforked_worker(heartbeat_slot, *args, **kwargs):
+    claim_heartbeat_slot(heartbeat_slot)
+    _prefork_target.start_forked(*args, **kwargs)
+
+
+def _exit_worker(signum, frame):
+    # raising (rather than dying) releases any pool queue locks held by an idle worker,
+    # which would otherwise deadlock terminating the pool
+    exit(128 + signum)
+
+
+def _init_worker(heartbeat_table):
+    # workers must not inherit the master's shutdown handling; until the state machine
+    # installs its own handlers, signals end the worker
+    for signum in (SIGINT, SIGTERM):
+        signal(signum, _exit_worker)
+    # profiles may be requested of any worker (see the healthcheck server); workers
+    # without a sampling profiler must not die of it
+    signal(PROFILE_SIGNAL, SIG_IGN)
+    attach_heartbeat_table(heartbeat_table)
+
+
+def _start_supervised_worker(heartbeat_table, func, *args, **kwargs):
+    _init_worker(heartbeat_table)
+    func(*args, **kwargs)
+
+
+class Supervisor:
+    """
+    Run one worker process per slot and restart workers that crash.
+
+    Workers are not daemonic, so that they may start processes of their own (e.g. a
+    process work queue); they are stopped and joined explicitly instead.
+
+    A worker that exits cleanly is not restarted. A crashed worker (non-zero exit code)
+    is restarted after an exponential backoff; a worker that crashes more than
+    `max_restarts` times within `crash_loop_window` seconds is considered to be in a
+    crash loop, which ends supervision.
+
+    With an autoscaler, the number of workers is periodically adjusted between the
+    autoscaler's bounds; surplus workers are retired gracefully (SIGTERM).
+
+    """
+    def __init__(
+        self,
+        context,
+        worker_func_and_args,
+        processes,
+        kwargs=None,
+        heartbeat_table=None,
+        max_restarts=5,
+        crash_loop_window=60.0,
+        min_backoff=1.0,
+        max_backoff=30.0,
+        poll_interval=0.5,
+        autoscaler=None,
+        autoscale_interval=30.0,
+    ):
+        self.context = context
+        self.worker_func_and_args = worker_func_and_args
+        self.processes = processes
+        self.kwargs = kwargs or dict()
+        self.heartbeat_table = heartbeat_table
+        self.max_restarts = max_restarts
+        self.crash_loop_window = crash_loop_window
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.autoscaler = autoscaler
+        self.autoscale_interval = autoscale_interval
+        self.next_autoscale_time = monotonic() + autoscale_interval
+        self.max_processes = autoscaler.max_processes if autoscaler else processes
+
+        self.workers = dict()
+        self.retiring = set()
+        self.pending_restarts = dict()
+        self.crashes = defaultdict(deque)
+        self.restarts = defaultdict(int)
+        self.crash_looping = False
+
+    def start(self):
+        for slot in range(self.processes):
+            self.start_worker(slot)
+
+    def start_worker(self, slot):
+        func, args = self.worker_func_and_args(slot)
+        process = self.context.Process(
+            target=_start_supervised_worker,
+            args=(self.heartbeat_table, func) + args,
+            kwargs=self.kwargs,
+            daemon=False,
+        )
+        process.start()
+        self.workers[slot] = process
+
+    def backoff(self, crashes):
+        return min(self.max_backoff, self.min_backoff * 2 ** (crashes - 1))
+
+    def check(self, now=None):
+        """
+        Reap exited workers and restart crashed workers whose backoff has elapsed.
+
+        Returns whether there is anything left to supervise.
+
+        """
+        now = monotonic() if now is None else now
+
+        for slot, process in list(self.workers.items()):
+            if process.exitcode is None:
+                continue
+
+            del self.workers[slot]
+            if slot in self.retiring:
+                logger.info("Worker %s (pid %s) retired", slot, process.pid)
+                self.retiring.discard(slot)
+                if self.heartbeat_table is not None:
+                    self.heartbeat_table.clear(slot)
+                continue
+
+            if process.exitcode == 0:
+                logger.info("Worker %s (pid %s) exited", slot, process.pid)
+                continue
+
+            crashes = self.crashes[slot]
+            crashes.append(now)
+            while crashes[0] < now - self.crash_loop_window:
+                crashes.popleft()
+
+            if len(crashes) > self.max_restarts:
+                logger.error(
+                    "Worker %s crashed %s times in %ss; giving up",
+                    slot,
+                    len(crashes),
+                    self.crash_loop_window,
+                )
+                self.crash_looping = True
+                return False
+
+            backoff = self.backoff(len(crashes))
+            logger.warning(
+                "Worker %s (pid %s) crashed with exit code %s; restarting in %ss",
+                slot,
+                process.pid,
+                process.exitcode,
+                backoff,
+            )
+            self.pending_restarts[slot] = now + backoff
+
+        for slot, restart_time in list(self.pending_restarts.items()):
+            if restart_time <= now:
+                del self.pending_restarts[slot]
+                self.restarts[slot] += 1
+                self.start_worker(slot)
+
+        self.autoscale(now)
+
+        return bool(self.workers or self.pending_restarts)
+
+    def active_slots(self):
+        """
+        Slots with a running (and not retiring) or soon-to-be-restarted worker.
+
+        """
+        return sorted((set(self.workers) - self.retiring) | set(self.pending_restarts))
+
+    def scale(self, processes):
+        """
+        Start or retire workers so that `processes` slots are active.
+
+        """
+        active = self.active_slots()
+
+        if processes > len(active):
+            free = [
+                slot
+                for slot in range(self.max_processes)
+                if slot not in self.workers and slot not in self.pending_restarts
+            ]
+            for slot in free[:processes - len(active)]:
+                self.start_worker(slot)
+
+        for slot in reversed(active[processes:]):
+            if slot in self.pending_restarts:
+                del self.pending_restarts[slot]
+            else:
+                self.retire_worker(slot)
+
+    def retire_worker(self, slot):
+        self.retiring.add(slot)
+        # the worker's signal handler lets the current state finish
+        self.workers[slot].terminate()
+
+    def autoscale(self, now):
+        if self.autoscaler is None or now < self.next_autoscale_time:
+            return
+
+        self.next_autoscale_time = now + self.autoscale_interval
+        active = self.active_slots()
+        idle_ratio = self.autoscaler.observe(self.heartbeat_table, active)
+        processes = self.autoscaler.desired_processes(len(active), idle_ratio)
+        if processes != len(active):
+            logger.info(
+                "Scaling from %s to %s workers (idle ratio: %s)",
+                len(active),
+                processes,
+                idle_ratio,
+            )
+            self.scale(processes)
+
+    def run(self):
+        """
+        Supervise workers until none are left or a crash loop is detected.
+
+        """
+        while self.check():
+            sleep(self.poll_interval)
+
+    def stop(self, terminate=False):
+        self.pending_restarts.clear()
+        for process in self.workers.values():
+            if terminate:
+                process.terminate()
+        for process in self.workers.values():
+            process.join()
+
+
 class ProcessRunner:
     """
     Run a daemon in a different process.
 
+    On SIGINT/SIGTERM, workers are drained: the signal is forwarded so that each worker
+    finishes its current step and exits, and workers still running after `drain_timeout`
+    seconds are killed.
+
     """
 
-    def __init__(self, target, processes, *args, **kwargs):
+    def __init__(
+        self,
+        target,
+        processes,
+        *args,
+        prefork=False,
+        supervise=False,
+        max_restarts=5,
+        max_processes=None,
+        drain_timeout=10.0,
+        **kwargs,
+    ):
         self.processes = processes
+        self.prefork = prefork
+        self.max_processes = max_processes if max_processes and max_processes > processes else None
+        # autoscaling requires supervised workers
+        self.supervise = supervise or self.max_processes is not None
+        self.max_restarts = max_restarts
+        self.drain_timeout = drain_timeout
+        self.draining = False
         self.target = target
         self.args = args
         self.kwargs = kwargs
         self.pool = None
+        self.pool_terminator = None
+        self.supervisor = None
         self.healthcheck_server = None
+        self.heartbeat_table = None
 
         self.init_signal_handlers()
         self.init_healthcheck_server(**kwargs)
+        self.init_autoscaling()
 
     def run(self):
+        if self.prefork:
+            self.init_prefork_target()
+
+        if self.supervise:
+            self.run_supervisor()
+            return
+
         self.pool = self.process_pool()
 
-        for _ in range(self.processes):
-            self.pool.apply_async(_start, (self.target,) + self.args, self.kwargs, error_callback=self.on_error)
+        for heartbeat_slot in range(self.processes):
+            self.pool.apply_async(
+                *self.worker_func_and_args(heartbeat_slot),
+                self.kwargs,
+                error_callback=self.on_error,
+            )
 
         if self.healthcheck_server:
-            self.healthcheck_server(self.processes, **self.kwargs)
+            self.healthcheck_server(self.processes, heartbeat_table=self.heartbeat_table, **self.kwargs)
             # The healthcheck server will block while running, and swallow any SystemExit exception
             # If we're reaching this point, we're exiting and need to re-raise `SystemExit`
             exit(0)
         else:
             self.close()
 
+    def run_supervisor(self):
+        """
+        Run workers under a supervisor that restarts crashed workers.
+
+        The healthcheck server (if any) runs in a background thread.
+
+        """
+        self.supervisor = self.process_supervisor()
+        self.supervisor.start()
+
+        if self.healthcheck_server:
+            Thread(
+                target=self.healthcheck_server,
+                args=(self.processes,),
+                kwargs=dict(heartbeat_table=self.heartbeat_table, **self.kwargs),
+                name="healthcheck-server",
+                daemon=True,
+            ).start()
+
+        self.supervisor.run()
+        self.close(terminate=True, exit_code=1 if self.supervisor.crash_looping else 0)
+
+    def init_prefork_target(self):
+        """
+        Initialize the target once so that forked workers inherit its object graph.
+
+        """
+        global _prefork_target
+        self.target.initialize()
+        _prefork_target = self.target
+
+    def worker_func_and_args(self, heartbeat_slot):
+        if self.prefork:
+            # the target is inherited through the fork and must not be pickled
+            return _start_preforked_worker, (heartbeat_slot,) + self.args
+        return _start_worker, (heartbeat_slot, self.target) + self.args
+
     def init_signal_handlers(self):
         for signum in (SIGINT, SIGTERM):
             signal(signum, self.on_terminate)
 
-    def init_healthcheck_server(self, heartbeat_threshold_seconds: int = -1, **kwargs):
+    def init_healthcheck_server(
+        self,
+        heartbeat_threshold_seconds: int = -1,
+        healthcheck_backend: str = "flask",
+        **kwargs,
+    ):
         if heartbeat_threshold_seconds < 0:
             self.healthcheck_server = None
             return
 
-        from microcosm_daemon.healthcheck_server import run
+        # import only the selected backend; the standard library one avoids Flask/waitress
+        if healthcheck_backend == "stdlib":
+            from microcosm_daemon.stdlib_healthcheck_server import run
+        else:
+            from microcosm_daemon.healthcheck_server import run
         self.healthcheck_server = run
+        self.heartbeat_table = HeartbeatTable(self.max_processes or self.processes)
+
+    def init_autoscaling(self):
+        if self.max_processes is None:
+            return
+
+        # workers report their activity through the heartbeat table
+        if self.heartbeat_table is None:
+            self.heartbeat_table = HeartbeatTable(self.max_processes)
 
     def process_pool(self):
-        return Pool(processes=self.processes)
+        context = get_context("fork") if self.prefork else get_context()
+
+        return context.Pool(
+            processes=self.processes,
+            initializer=_init_worker,
+            initargs=(self.heartbeat_table,),
+        )
+
+    def process_supervisor(self):
+        return Supervisor(
+            context=get_context("fork") if self.prefork else get_context(),
+            worker_func_and_args=self.worker_func_and_args,
+            processes=self.processes,
+            kwargs=self.kwargs,
+            heartbeat_table=self.heartbeat_table,
+            max_restarts=self.max_restarts,
+            autoscaler=self.process_autoscaler(),
+        )
+
+    def process_autoscaler(self):
+        if self.max_processes is None:
+            return None
+
+        from microcosm_daemon.autoscaler import Autoscaler
+
+        backlog_probe = getattr(self.target, "autoscale_backlog", None)
+        if backlog_probe is not None and not self.prefork and self.overrides_backlog_probe():
+            # the probe runs in this (master) process; give it an object graph to use
+            self.target.initialize()
+
+        return Autoscaler(
+            min_processes=self.processes,
+            max_processes=self.max_processes,
+            backlog_probe=backlog_probe,
+        )
+
+    def overrides_backlog_probe(self):
+        from microcosm_daemon.daemon import Daemon
+
+        return getattr(type(self.target), "autoscale_backlog", None) is not Daemon.autoscale_backlog
+
+    def close(self, terminate=False, exit_code=0):
+        if self.supervisor is not None:
+            self.supervisor.stop(terminate=terminate)
 
-    def close(self, terminate=False):
         if self.pool is not None:
-            if terminate:
-                self.pool.terminate()
+            if self.pool_terminator is not None:
+                # the pool was already terminated while draining
+                self.pool_terminator.join()
             else:
-                self.pool.close()
+                if terminate:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
 
-            self.pool.join()
+                self.pool.join()
 
-        exit(0)
+        exit(exit_code)
 
     def on_error(self, error):
         logger.error("Error while running async processor: %s", error)
-        self.close(terminate=True)
+        # error callbacks run in the pool's result handler thread, which cannot terminate
+        # (and join) its own pool; shut down from the main thread instead
+        kill(getpid(), SIGTERM)
+
+    def drain(self, signum=SIGTERM):
+        """
+        Forward a signal to all workers and wait (up to the drain timeout) for them to exit.
+
+        Workers that are still running at the deadline are killed.
+
+        """
+        self.draining = True
+        workers = active_children()
+        if self.pool is not None:
+            # a pool replaces workers that exit until it is terminated; terminating stops
+            # replacing workers before signalling them (with SIGTERM) and joining them
+            self.pool_terminator = Thread(target=self.pool.terminate, name="pool-terminator", daemon=True)
+            self.pool_terminator.start()
+        else:
+            for worker in workers:
+                try:
+                    kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        deadline = monotonic() + self.drain_timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - monotonic()))
+
+        stragglers = [worker for worker in workers if worker.is_alive()]
+        for worker in stragglers:
+            logger.warning("Killing worker (pid %s) after drain timeout", worker.pid)
+            worker.kill()
 
     def on_terminate(self, signum, frame):
+        if self.draining:
+            # the drain deadline already bounds shutdown
+            return
+
+        self.drain(signum)
         self.close(terminate=True)
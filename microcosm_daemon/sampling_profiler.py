@@ -0,0 +1,138 @@
+"""
+Sampling profiler for running daemons.
+
+"""
+import sys
+from collections import Counter
+from logging import getLogger
+from os import getpid, path
+from signal import SIGUSR1, signal
+from tempfile import gettempdir
+from threading import (
+    Lock,
+    Thread,
+    enumerate as threads,
+    get_ident,
+)
+from time import monotonic, sleep, time
+
+from microcosm.api import defaults, typed
+
+from microcosm_daemon.heartbeat import state_name
+
+
+logger = getLogger("daemon.sampling_profiler")
+
+# the signal that starts a profile (see `ProcessRunner`, which ignores it by default)
+PROFILE_SIGNAL = SIGUSR1
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of all threads for a while and write them as collapsed stacks.
+
+    Profiles start on `PROFILE_SIGNAL` (e.g. sent by the healthcheck server to one
+    worker). A background thread samples `sys._current_frames()` every `interval`
+    seconds for `duration` seconds; until then, the profiler costs nothing.
+
+    Stacks of threads running a state machine are rooted at the machine's current
+    state, so that the output (one `frame;frame;... count` line per stack, as read by
+    flamegraph tools) can be broken down by state.
+
+    """
+    def __init__(self, name, interval=0.005, duration=30.0, output_dir=None):
+        self.name = name
+        self.interval = interval
+        self.duration = duration
+        self.output_dir = output_dir or gettempdir()
+        # thread ident -> state machine running in that thread
+        self.state_machines = dict()
+        self.lock = Lock()
+        self.thread = None
+
+    def install(self):
+        """
+        Start profiles on `PROFILE_SIGNAL`. Must be called from the main thread.
+
+        """
+        signal(PROFILE_SIGNAL, self.on_signal)
+
+    def watch(self, state_machine):
+        """
+        Tag samples of the calling thread with the state machine's current state.
+
+        """
+        self.state_machines[get_ident()] = state_machine
+
+    def on_signal(self, signalnum, frame):
+        self.start()
+
+    def start(self, duration=None):
+        """
+        Start a profile in the background, unless one is running.
+
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return None
+            self.thread = Thread(
+                target=self.run,
+                args=(self.duration if duration is None else duration,),
+                name="sampling-profiler",
+                daemon=True,
+            )
+            self.thread.start()
+            return self.thread
+
+    def run(self, duration):
+        logger.info("Profiling for %ss", duration)
+        stacks = self.sample(duration)
+        filename = path.join(self.output_dir, f"{self.name}-{getpid()}-{int(time())}.collapsed")
+        with open(filename, "w") as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        logger.info("Wrote profile to %s", filename, extra=dict(profile=filename))
+
+    def sample(self, duration):
+        own = get_ident()
+        thread_names = {thread.ident: thread.name for thread in threads()}
+        stacks = Counter()
+        deadline = monotonic() + duration
+        while monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stacks[self.collapse(ident, frame, thread_names)] += 1
+            sleep(self.interval)
+        return stacks
+
+    def collapse(self, ident, frame, thread_names):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+
+        state_machine = self.state_machines.get(ident)
+        if state_machine is not None:
+            root = f"state: {state_name(state_machine.current_state)}"
+        else:
+            root = f"thread: {thread_names.get(ident, ident)}"
+
+        frames.append(root)
+        return ";".join(reversed(frames))
+
+
+@defaults(
+    interval=typed(float, 0.005),
+    duration=typed(float, 30.0),
+    # defaults to the system temporary directory
+    output_dir="",
+)
+def configure_sampling_profiler(graph):
+    return SamplingProfiler(
+        name=graph.metadata.name,
+        interval=graph.config.sampling_profiler.interval,
+        duration=graph.config.sampling_profiler.duration,
+        output_dir=graph.config.sampling_profiler.output_dir or None,
+    )
@@ -4,19 +4,28 @@ Signal handling.
 """
 from signal import SIGINT, SIGTERM, signal
 
+from microcosm_daemon.wake_up import WakeUpPipe
+
 
 class SignalHandler:
     """
     Handle signals raised during state machine execution.
 
+    Interruption also sets the `shutdown` wake-up pipe, which ends any sleep in progress.
+
     """
 
     def __init__(self):
         self.signalnums = [SIGINT, SIGTERM]
         self.interrupted = False
+        self.shutdown = WakeUpPipe()
 
     def __call__(self, signalnum, frame):
+        self.interrupt()
+
+    def interrupt(self):
         self.interrupted = True
+        self.shutdown.set()
 
     def __enter__(self):
         for signalnum in self.signalnums:
@@ -25,6 +34,14 @@ class SignalHandler:
     def __exit__(self, type, value, traceback):
         pass
 
+    def add_to_loop(self, loop):
+        """
+        Handle signals through an asyncio event loop.
+
+        """
+        for signalnum in self.signalnums:
+            loop.add_signal_handler(signalnum, self, signalnum, None)
+
 
 def configure_signal_handler(graph):
     return SignalHandler()
@@ -2,12 +2,19 @@
 Sleep policy.
 
 """
+from os import close, dup, getpid
+from random import uniform
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from signal import signal
 from time import sleep
 
 from microcosm.api import defaults
+from microcosm.config.types import boolean
 from microcosm.config.validation import typed
 from microcosm_logging.decorators import logger
 
+from microcosm_daemon.wake_up import WakeUpPipe
+
 
 class SleepNow(Exception):
 
@@ -15,35 +22,303 @@ class SleepNow(Exception):
         self.sleep_timeout = sleep_timeout
 
 
+class WaitFor(SleepNow):
+    """
+    Sleep until one of the given file objects is ready (or the sleep timeout expires).
+
+    File objects are file descriptors or objects with a `fileno()` method: sockets, pipes,
+    or a `WakeUpPipe` used as an event.
+
+    """
+    def __init__(self, fileobjs, sleep_timeout=None, events=EVENT_READ):
+        super().__init__(sleep_timeout)
+        if isinstance(fileobjs, int) or hasattr(fileobjs, "fileno"):
+            fileobjs = [fileobjs]
+        self.fileobjs = fileobjs
+        self.events = events
+
+
 @logger
 class SleepPolicy:
     """
     Determine whether to sleep before processing another state function.
 
+    Given a `shutdown` wake-up pipe (see `SignalHandler`), sleeps end as soon as the
+    daemon is interrupted rather than waiting out the sleep timeout.
+
+    A `WaitFor` sleeps in the same way, but also ends as soon as one of its file objects
+    is ready, so that states can react to new data without polling.
+
     """
-    def __init__(self, default_sleep_timeout):
+    def __init__(self, default_sleep_timeout, shutdown=None):
         self.default_sleep_timeout = default_sleep_timeout
+        self.shutdown = shutdown
+        self.selector = None
+        self.selector_pid = None
+        # count steps and sleeps so that idleness can be reported
+        self.steps = 0
+        self.sleeps = 0
+
+    def wake_up_pipes(self):
+        """
+        Define the pipes that end a sleep early.
+
+        """
+        return [self.shutdown] if self.shutdown is not None else []
+
+    def ensure_selector(self):
+        """
+        Create a selector over the wake-up pipes (again, if this process was forked).
+
+        """
+        if self.selector_pid != getpid():
+            self.selector_pid = getpid()
+            self.selector = DefaultSelector()
+            for wake_up_pipe in self.wake_up_pipes():
+                self.selector.register(wake_up_pipe.fileno(), EVENT_READ, wake_up_pipe)
+        return self.selector
+
+    def __copy__(self):
+        # copies (e.g. one per thread runner lane) register `WaitFor` file objects in
+        # their own selector
+        sleep_policy = self.__class__.__new__(self.__class__)
+        sleep_policy.__dict__.update(self.__dict__)
+        sleep_policy.selector = None
+        sleep_policy.selector_pid = None
+        return sleep_policy
+
+    def on_wake_up(self, wake_up_pipe):
+        """
+        Handle a sleep ended by a wake-up pipe.
+
+        The shutdown pipe is never cleared so that subsequent sleeps also end immediately.
+
+        """
+        pass
 
     def sleep(self, sleep_timeout):
         """
         Patch target for sleeping.
 
         """
-        sleep(sleep_timeout)
+        if not self.wake_up_pipes():
+            sleep(sleep_timeout)
+            return
+
+        for key, _ in self.ensure_selector().select(sleep_timeout):
+            self.on_wake_up(key.data)
+
+    def wait_for(self, wait_for, sleep_timeout):
+        """
+        Patch target for sleeping until a file object (or wake-up pipe) is ready.
+
+        The file objects are only registered for the duration of the sleep.
+
+        """
+        selector = self.ensure_selector()
+        registered = []
+        try:
+            for fileobj in wait_for.fileobjs:
+                selector.register(fileobj, wait_for.events)
+                registered.append(fileobj)
+
+            for key, _ in selector.select(sleep_timeout):
+                if key.data is not None:
+                    self.on_wake_up(key.data)
+        finally:
+            for fileobj in registered:
+                selector.unregister(fileobj)
+
+    async def async_sleep(self, sleep_timeout):
+        """
+        Patch target for sleeping without blocking the event loop.
+
+        """
+        if not self.wake_up_pipes():
+            from asyncio import sleep as async_sleep
+            await async_sleep(sleep_timeout)
+            return
+
+        await self.async_select([], EVENT_READ, sleep_timeout)
+
+    async def async_wait_for(self, wait_for, sleep_timeout):
+        """
+        Patch target for waiting on file objects without blocking the event loop.
+
+        """
+        await self.async_select(wait_for.fileobjs, wait_for.events, sleep_timeout)
+
+    async def async_select(self, fileobjs, events, sleep_timeout):
+        # asyncio is slow to import and only needed on an event loop (where it is loaded)
+        from asyncio import get_event_loop, wait
+
+        loop = get_event_loop()
+        ready = loop.create_future()
+
+        def on_ready(wake_up_pipe):
+            if not ready.done():
+                ready.set_result(wake_up_pipe)
+
+        # an event loop watches each descriptor for one callback only, so concurrent
+        # sleepers (e.g. several state machines on one loop) watch their own duplicates
+        # of the shared wake-up pipes
+        duplicates = [
+            (dup(wake_up_pipe.fileno()), wake_up_pipe)
+            for wake_up_pipe in self.wake_up_pipes()
+        ]
+        watched = [
+            (fileno, EVENT_READ, wake_up_pipe)
+            for fileno, wake_up_pipe in duplicates
+        ] + [
+            (fileobj, events, None)
+            for fileobj in fileobjs
+        ]
+        added = []
+        try:
+            for fileobj, fileobj_events, wake_up_pipe in watched:
+                if fileobj_events & EVENT_READ:
+                    loop.add_reader(fileobj, on_ready, wake_up_pipe)
+                    added.append((loop.remove_reader, fileobj))
+                if fileobj_events & EVENT_WRITE:
+                    loop.add_writer(fileobj, on_ready, wake_up_pipe)
+                    added.append((loop.remove_writer, fileobj))
+            await wait([ready], timeout=sleep_timeout)
+        finally:
+            for remove, fileobj in added:
+                remove(fileobj)
+            for fileno, _ in duplicates:
+                close(fileno)
+
+        if not ready.done():
+            ready.cancel()
+        elif ready.result() is not None:
+            self.on_wake_up(ready.result())
+
+    def compute_sleep_timeout(self, sleep_now):
+        """
+        Compute how long to sleep for a `SleepNow` (or `WaitFor`).
+
+        """
+        return sleep_now.sleep_timeout or self.default_sleep_timeout
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
+        self.steps += 1
         if type is SleepNow:
-            self.sleep(value.sleep_timeout or self.default_sleep_timeout)
+            self.sleeps += 1
+            self.sleep(self.compute_sleep_timeout(value))
             return True
+        if type is WaitFor:
+            self.sleeps += 1
+            self.wait_for(value, self.compute_sleep_timeout(value))
+            return True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.steps += 1
+        if type is SleepNow:
+            self.sleeps += 1
+            await self.async_sleep(self.compute_sleep_timeout(value))
+            return True
+        if type is WaitFor:
+            self.sleeps += 1
+            await self.async_wait_for(value, self.compute_sleep_timeout(value))
+            return True
+
+
+class AdaptiveSleepPolicy(SleepPolicy):
+    """
+    Back off exponentially across consecutive sleeps and wake up early on demand.
+
+    Each consecutive `SleepNow` multiplies the sleep timeout by `backoff_factor` (up to
+    `max_sleep_timeout`), with +/- `jitter` (as a fraction) to spread out workers. The
+    first productive step resets the backoff.
+
+    Sleeps end early on a wake-up: call `wake_up()` (thread- and signal-safe), write to
+    `wake_up_fd`, or use `wake_on_signal()`.
+
+    """
+    def __init__(
+        self,
+        default_sleep_timeout,
+        max_sleep_timeout,
+        backoff_factor=2.0,
+        jitter=0.1,
+        shutdown=None,
+    ):
+        super().__init__(default_sleep_timeout, shutdown=shutdown)
+        self.max_sleep_timeout = max_sleep_timeout
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.consecutive_sleeps = 0
+        self.wake_up_pipe = WakeUpPipe()
+
+    def compute_sleep_timeout(self, sleep_now):
+        sleep_timeout = super().compute_sleep_timeout(sleep_now) * self.backoff_factor ** self.consecutive_sleeps
+        # stop backing off once capped, so that the exponent cannot grow without bound
+        if 0 < sleep_timeout < self.max_sleep_timeout:
+            self.consecutive_sleeps += 1
+
+        if self.jitter:
+            sleep_timeout *= uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        return min(self.max_sleep_timeout, sleep_timeout)
+
+    def wake_up_pipes(self):
+        return super().wake_up_pipes() + [self.wake_up_pipe]
+
+    @property
+    def wake_up_fd(self):
+        """
+        A file descriptor that ends the current (or next) sleep when written to.
+
+        """
+        return self.wake_up_pipe.writer_fileno()
+
+    def wake_up(self):
+        self.wake_up_pipe.set()
+
+    def wake_on_signal(self, signalnum):
+        signal(signalnum, lambda signalnum, frame: self.wake_up())
+
+    def on_wake_up(self, wake_up_pipe):
+        if wake_up_pipe is self.wake_up_pipe:
+            wake_up_pipe.clear()
+            # there is likely new work, so don't keep backing off
+            self.consecutive_sleeps = 0
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.consecutive_sleeps = 0
+        return super().__exit__(type, value, traceback)
+
+    async def __aexit__(self, type, value, traceback):
+        if type is None:
+            self.consecutive_sleeps = 0
+        return await super().__aexit__(type, value, traceback)
 
 
 @defaults(
     default_sleep_timeout=typed(float, 0.5),
+    adaptive=typed(boolean, False),
+    max_sleep_timeout=typed(float, 30.0),
+    backoff_factor=typed(float, 2.0),
+    jitter=typed(float, 0.1),
 )
 def configure_sleep_policy(graph):
+    if graph.config.sleep_policy.adaptive:
+        return AdaptiveSleepPolicy(
+            default_sleep_timeout=graph.config.sleep_policy.default_sleep_timeout,
+            max_sleep_timeout=graph.config.sleep_policy.max_sleep_timeout,
+            backoff_factor=graph.config.sleep_policy.backoff_factor,
+            jitter=graph.config.sleep_policy.jitter,
+            shutdown=graph.signal_handler.shutdown,
+        )
+
     return SleepPolicy(
         default_sleep_timeout=graph.config.sleep_policy.default_sleep_timeout,
+        shutdown=graph.signal_handler.shutdown,
     )
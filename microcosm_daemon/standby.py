@@ -20,6 +20,8 @@ class StandByGuard:
         self.next_state = next_state
         self.condition = condition
         self.standby_timeout = standby_timeout
+        # a new guard wraps each step; metrics are recorded for the wrapped state
+        self.__wrapped__ = next_state
 
     def __str__(self):
         return str(self.next_state)
@@ -101,8 +103,8 @@ class StandByMixin(metaclass=ABCMeta):
         """
         Define the sleep interface while in standby.
 
-        Defaults to 1s; longer sleep intervals will delay both coming out of standby
-        and interrupting/terminating the daemon (depending on signal handling).
+        Defaults to 1s; longer sleep intervals will delay coming out of standby
+        (interrupting the daemon ends the sleep early).
 
         """
         return 1.0
@@ -0,0 +1,98 @@
+"""
+Startup-time profiling (see `--profile-startup`).
+
+"""
+from contextlib import contextmanager
+from logging import getLogger
+from os import getpid, sysconf
+from time import perf_counter, process_time
+
+
+logger = getLogger("daemon.startup_profile")
+
+
+def process_uptime():
+    """
+    Seconds since this process started.
+
+    Falls back to CPU time where `/proc` is unavailable.
+
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            # skip past the (parenthesized, arbitrary) command name
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as uptime:
+            system_uptime = float(uptime.read().split()[0])
+        return system_uptime - int(fields[19]) / sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return process_time()
+
+
+class FactoryProfiler:
+    """
+    Time each component factory (as a microcosm object graph profiler).
+
+    Factories that use components not yet built also build those; each factory's own
+    time excludes such nested factories.
+
+    """
+    def __init__(self):
+        # key -> (total seconds, own seconds)
+        self.timings = dict()
+        # time spent in nested factories, per factory being built
+        self.nested = []
+
+    @contextmanager
+    def __call__(self, key):
+        start = perf_counter()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            total = perf_counter() - start
+            nested = self.nested.pop()
+            if self.nested:
+                self.nested[-1] += total
+            self.timings[key] = (total, total - nested)
+
+
+class StartupProfile:
+    """
+    Record the time spent in each phase of daemon startup, and in each factory.
+
+    """
+    def __init__(self):
+        self.timings = []
+        self.factories = FactoryProfiler()
+
+    def record(self, phase, seconds):
+        self.timings.append((phase, seconds))
+
+    @contextmanager
+    def phase(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, perf_counter() - start)
+
+    def report(self):
+        width = max((len(phase) for phase, _ in self.timings), default=0)
+        lines = [
+            f"  {phase.ljust(width)}  {seconds * 1000:9.1f} ms"
+            for phase, seconds in self.timings
+        ]
+        if self.factories.timings:
+            factories = sorted(self.factories.timings.items(), key=lambda item: -item[1][1])
+            width = max(len(key) for key, _ in factories)
+            lines.append(f"  {'factory'.ljust(width)}  {'own':>9}     {'total':>9}")
+            lines.extend(
+                f"  {key.ljust(width)}  {own * 1000:9.1f} ms  {total * 1000:9.1f} ms"
+                for key, (total, own) in factories
+            )
+        logger.info(
+            "Startup profile (pid %s):\n%s",
+            getpid(),
+            "\n".join(lines),
+        )
@@ -2,27 +2,79 @@
 State machine processing.
 
 """
-from microcosm_daemon.reloader import Reloader
+from time import perf_counter, thread_time
+
+from microcosm_daemon.heartbeat import get_heartbeat_slot
+from microcosm_daemon.prefetch import Pipeline, PrefetchingState
 
 
 class StateMachine:
     """
     A state machine for driving daemon processing.
 
+    By default, each step is taken within its own error and sleep policy scope. With a
+    `batch_size` greater than one, up to that many steps (optionally bounded further by a
+    `batch_time_budget` in seconds) are taken within a single scope, amortizing policy
+    bookkeeping for very fast states.
+
+    Given `metrics` (see `StateMetrics`), steps record per-state timings, errors and
+    sleeps (within a batch, only the step that raised is charged the sleep). Workers
+    with a heartbeat slot report the latency and state of their latest step.
+
+    Given a `profiler` (see `SamplingProfiler`), profiles may be started (by signal)
+    while the state machine runs.
+
+    With a `pipeline_depth`, states declared with `@prefetch` fetch up to that many
+    results ahead (see `Pipeline`) while the state machine runs.
+
     """
-    def __init__(self, graph, initial_state, never_reload=False):
+    def __init__(
+        self,
+        graph,
+        initial_state,
+        never_reload=False,
+        error_policy=None,
+        sleep_policy=None,
+        batch_size=1,
+        batch_time_budget=None,
+        metrics=None,
+        profiler=None,
+        pipeline_depth=0,
+    ):
         self.graph = graph
+        self.pipeline_depth = pipeline_depth
+        # prefetching state -> pipeline
+        self.pipelines = dict() if pipeline_depth > 0 else None
         self.current_state = initial_state
-        self.reloader = Reloader() if graph.metadata.debug and not never_reload else None
+        self.batch_size = batch_size
+        self.batch_time_budget = batch_time_budget
+        self.metrics = metrics
+        self.profiler = profiler
+        self.heartbeat_slot = get_heartbeat_slot()
+        self.timed = metrics is not None or self.heartbeat_slot is not None
+        # policies default to the graph's, but may be given per state machine (e.g. per thread)
+        self.error_policy = graph.error_policy if error_policy is None else error_policy
+        self.sleep_policy = graph.sleep_policy if sleep_policy is None else sleep_policy
+        if self.heartbeat_slot is not None:
+            self.heartbeat_slot.watch(self.sleep_policy)
+        self.reloader = None
+        if graph.metadata.debug and not never_reload:
+            from microcosm_daemon.reloader import Reloader
+            self.reloader = Reloader()
+        if self.pipelines is not None:
+            self.current_state = self.pipelined(initial_state)
 
     def step(self):
         """
         Take one step through the state transition.
 
         """
+        if self.timed:
+            return self.step_with_metrics()
+
         next_state = None
-        with self.graph.error_policy:
-            with self.graph.sleep_policy:
+        with self.error_policy:
+            with self.sleep_policy:
                 next_state = self.current_state(self.graph)
 
         if callable(next_state):
@@ -32,14 +84,143 @@ class StateMachine:
             # stay in the same state
             return self.current_state
 
+    def step_with_metrics(self):
+        """
+        Take one step through the state transition, recording metrics (and latency).
+
+        """
+        state = self.current_state
+        next_state = None
+        error_type = None
+        wall_start, cpu_start = perf_counter(), thread_time()
+        wall_end, cpu_end = wall_start, cpu_start
+
+        try:
+            with self.error_policy:
+                with self.sleep_policy:
+                    try:
+                        next_state = state(self.graph)
+                    except BaseException as error:
+                        error_type = type(error)
+                        raise
+                    finally:
+                        wall_end, cpu_end = perf_counter(), thread_time()
+        finally:
+            self.record_step(
+                state,
+                wall_end - wall_start,
+                cpu_end - cpu_start,
+                error_type,
+                # any time after the state returned is spent in the policies (i.e. sleeping)
+                sleep_time=perf_counter() - wall_end,
+            )
+
+        if callable(next_state):
+            # advance to a new state
+            return next_state
+        else:
+            # stay in the same state
+            return self.current_state
+
+    def step_batch(self):
+        """
+        Take a batch of steps within one error and sleep policy scope.
+
+        The batch ends after `batch_size` steps, once `batch_time_budget` elapses, or as
+        soon as a state raises (including `SleepNow`); the state that raised remains the
+        current state. Policies observe one step per batch.
+
+        """
+        deadline = None
+        if self.batch_time_budget is not None:
+            deadline = perf_counter() + self.batch_time_budget
+
+        timed = self.timed
+        signal_handler = self.graph.signal_handler
+        state = error_type = None
+        wall_start = wall_end = cpu_start = cpu_end = 0.0
+
+        try:
+            with self.error_policy:
+                with self.sleep_policy:
+                    for _ in range(self.batch_size):
+                        state = self.current_state
+                        if not timed:
+                            next_state = state(self.graph)
+                        else:
+                            wall_start, cpu_start = perf_counter(), thread_time()
+                            try:
+                                next_state = state(self.graph)
+                            except BaseException as error:
+                                error_type = type(error)
+                                raise
+                            finally:
+                                wall_end, cpu_end = perf_counter(), thread_time()
+                            self.record_step(state, wall_end - wall_start, cpu_end - cpu_start)
+
+                        if callable(next_state):
+                            if self.pipelines is not None:
+                                next_state = self.pipelined(next_state)
+                            self.current_state = next_state
+                        if signal_handler.interrupted:
+                            break
+                        if deadline is not None and perf_counter() >= deadline:
+                            break
+        finally:
+            if error_type is not None:
+                self.record_step(
+                    state,
+                    wall_end - wall_start,
+                    cpu_end - cpu_start,
+                    error_type,
+                    sleep_time=perf_counter() - wall_end,
+                )
+
+        return self.current_state
+
+    def record_step(self, state, wall_time, cpu_time, error_type=None, sleep_time=0.0):
+        if self.metrics is not None:
+            self.metrics.record(state, wall_time, cpu_time, error_type, sleep_time)
+        if self.heartbeat_slot is not None:
+            self.heartbeat_slot.observe(state, wall_time)
+
     def advance(self):
         """
-        Advance once step.
+        Advance once step (or one batch of steps).
 
         """
-        self.current_state = self.step()
+        if self.batch_size > 1:
+            next_state = self.step_batch()
+        else:
+            next_state = self.step()
+
+        if self.pipelines is not None:
+            next_state = self.pipelined(next_state)
+        self.current_state = next_state
         return self.current_state
 
+    def pipelined(self, state):
+        """
+        Run a prefetching state through its pipeline (starting on first use).
+
+        """
+        if not isinstance(state, PrefetchingState):
+            return state
+
+        pipeline = self.pipelines.get(state)
+        if pipeline is None:
+            pipeline = self.pipelines[state] = Pipeline(
+                state,
+                self.graph,
+                self.pipeline_depth,
+                self.sleep_policy.default_sleep_timeout,
+            )
+        return pipeline
+
+    def stop_pipelines(self):
+        for pipeline in (self.pipelines or dict()).values():
+            pipeline.stop()
+
     def should_run(self):
         """
         Should the state machine keep running?
@@ -55,11 +236,29 @@ class StateMachine:
         Run the state machine.
 
         """
+        if self.profiler is not None:
+            self.profiler.install()
+
         try:
             with self.graph.signal_handler:
-                while self.should_run():
-                    self.advance()
-                    if self.reloader:
-                        self.reloader()
+                self.run_loop()
         except Exception:
             pass
+
+    def run_loop(self):
+        """
+        Advance the state machine until it stops or is interrupted.
+
+        Does not install signal handlers.
+
+        """
+        if self.profiler is not None:
+            self.profiler.watch(self)
+
+        try:
+            while self.should_run():
+                self.advance()
+                if self.reloader:
+                    self.reloader()
+        finally:
+            self.stop_pipelines()
@@ -0,0 +1,249 @@
+"""
+Per-state latency and throughput metrics.
+
+"""
+from bisect import bisect_left
+from logging import getLogger
+from os import getpid
+from socket import AF_INET, SOCK_DGRAM, socket
+from time import perf_counter
+
+from microcosm.api import defaults, typed
+
+from microcosm_daemon.heartbeat import get_worker_slot, state_name
+from microcosm_daemon.sleep_policy import SleepNow
+
+
+logger = getLogger("daemon.state_metrics")
+
+
+# upper bounds (in seconds) of histogram buckets; the last bucket is unbounded
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+# keep StatsD datagrams below a typical MTU
+MAX_DATAGRAM_SIZE = 1432
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram (counts are not cumulative until exported).
+
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        cumulative, result = 0, []
+        for count in self.counts:
+            cumulative += count
+            result.append(cumulative)
+        return result
+
+
+class StateStats:
+    """
+    Metrics for a single state.
+
+    """
+    def __init__(self, buckets):
+        self.calls = 0
+        self.sleeps = 0
+        self.sleep_time = 0.0
+        self.errors = dict()
+        self.wall_time = Histogram(buckets)
+        self.cpu_time = Histogram(buckets)
+
+
+class StateMetrics:
+    """
+    Record per-state call counts, wall/CPU time histograms, errors by type, and sleep time.
+
+    Stats are allocated once per state name; recording a step only updates counters.
+    States that wrap another state (setting `__wrapped__`, e.g. `StandByGuard`) are
+    recorded as the wrapped state.
+
+    Given an `exporter` (e.g. `StatsdExporter`), metrics are pushed to it every
+    `export_interval` seconds, from whichever thread records a step.
+
+    """
+    def __init__(self, prefix="microcosm_daemon", buckets=DEFAULT_BUCKETS, exporter=None, export_interval=10.0):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.states = dict()
+        # (state, stats) of the most recently recorded state, updated atomically
+        self.last = (None, None)
+        self.exporter = exporter
+        self.export_interval = export_interval
+        self.next_export_time = perf_counter() + export_interval
+
+    def stats_for(self, state):
+        # states usually repeat (or wrap a repeating state), so avoid recomputing the
+        # state's name on every step
+        state = getattr(state, "__wrapped__", state)
+        last_state, last_stats = self.last
+        if state is last_state:
+            return last_stats
+
+        name = state_name(state)
+        stats = self.states.get(name)
+        if stats is None:
+            stats = self.states[name] = StateStats(self.buckets)
+
+        self.last = (state, stats)
+        return stats
+
+    def record(self, state, wall_time, cpu_time, error_type=None, sleep_time=0.0):
+        """
+        Record one step of a state.
+
+        `SleepNow` is recorded as a sleep rather than as an error.
+
+        """
+        stats = self.stats_for(state)
+        stats.calls += 1
+        stats.wall_time.observe(wall_time)
+        stats.cpu_time.observe(cpu_time)
+
+        if error_type is not None:
+            if issubclass(error_type, SleepNow):
+                stats.sleeps += 1
+                stats.sleep_time += sleep_time
+            else:
+                name = error_type.__name__
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+
+        if self.exporter is not None:
+            self.maybe_export()
+
+    def maybe_export(self, now=None):
+        """
+        Push metrics to the exporter once the export interval elapses.
+
+        """
+        if now is None:
+            now = perf_counter()
+        if now < self.next_export_time:
+            return
+
+        self.next_export_time = now + self.export_interval
+        try:
+            self.exporter(self)
+        except Exception as error:
+            logger.debug("Failed to export state metrics", extra=dict(error=error))  # noqa: G200
+
+    def to_prometheus(self):
+        """
+        Export metrics in the Prometheus text exposition format.
+
+        """
+        prefix = self.prefix
+        lines = [
+            f"# TYPE {prefix}_state_calls_total counter",
+            f"# TYPE {prefix}_state_sleeps_total counter",
+            f"# TYPE {prefix}_state_sleep_seconds_total counter",
+            f"# TYPE {prefix}_state_errors_total counter",
+            f"# TYPE {prefix}_state_wall_seconds histogram",
+            f"# TYPE {prefix}_state_cpu_seconds histogram",
+        ]
+        for name, stats in sorted(self.states.items()):
+            label = f'state="{escape_label(name)}"'
+            lines.append(f"{prefix}_state_calls_total{{{label}}} {stats.calls}")
+            lines.append(f"{prefix}_state_sleeps_total{{{label}}} {stats.sleeps}")
+            lines.append(f"{prefix}_state_sleep_seconds_total{{{label}}} {stats.sleep_time}")
+            for error, count in sorted(stats.errors.items()):
+                lines.append(f'{prefix}_state_errors_total{{{label},error="{error}"}} {count}')
+            for metric, histogram in (("wall", stats.wall_time), ("cpu", stats.cpu_time)):
+                bounds = [str(bucket) for bucket in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    lines.append(f'{prefix}_state_{metric}_seconds_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f"{prefix}_state_{metric}_seconds_sum{{{label}}} {histogram.total}")
+                lines.append(f"{prefix}_state_{metric}_seconds_count{{{label}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_statsd(self, worker=None):
+        """
+        Export metrics as StatsD gauge lines (cumulative values).
+
+        Given a `worker` (e.g. a process runner slot), keys are scoped to that worker.
+
+        """
+        prefix = self.prefix if worker is None else f"{self.prefix}.worker.{worker}"
+        lines = []
+        for name, stats in sorted(list(self.states.items())):
+            key = f"{prefix}.state.{escape_statsd(name)}"
+            lines.append(f"{key}.calls:{stats.calls}|g")
+            lines.append(f"{key}.sleeps:{stats.sleeps}|g")
+            lines.append(f"{key}.sleep_seconds:{stats.sleep_time}|g")
+            lines.append(f"{key}.wall_seconds:{stats.wall_time.total}|g")
+            lines.append(f"{key}.cpu_seconds:{stats.cpu_time.total}|g")
+            for error, count in sorted(stats.errors.items()):
+                lines.append(f"{key}.errors.{error}:{count}|g")
+        return lines
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def escape_statsd(value):
+    return "".join(char if char.isalnum() or char in "_-" else "_" for char in value)
+
+
+class StatsdExporter:
+    """
+    Push state metrics to a StatsD server over UDP.
+
+    Each process pushes its own metrics; under a process runner, keys are scoped to the
+    worker's slot (which is stable across worker restarts) so that workers do not
+    overwrite each other's gauges.
+
+    """
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = None
+        self.owner_pid = None
+
+    def __call__(self, metrics):
+        if self.owner_pid != getpid():
+            # do not share a socket with a forked parent
+            self.owner_pid = getpid()
+            self.sock = socket(AF_INET, SOCK_DGRAM)
+            self.sock.setblocking(False)
+
+        for datagram in self.datagrams(metrics.to_statsd(get_worker_slot())):
+            self.sock.sendto(datagram, self.address)
+
+    def datagrams(self, lines):
+        datagram = b""
+        for line in lines:
+            line = line.encode()
+            if datagram and len(datagram) + len(line) + 1 > MAX_DATAGRAM_SIZE:
+                yield datagram
+                datagram = b""
+            datagram = datagram + b"\n" + line if datagram else line
+        if datagram:
+            yield datagram
+
+
+@defaults(
+    prefix="microcosm_daemon",
+    # push metrics to StatsD (if a host is configured)
+    statsd_host="",
+    statsd_port=typed(int, 8125),
+    export_interval=typed(float, 10.0),
+)
+def configure_state_metrics(graph):
+    config = graph.config.state_metrics
+    return StateMetrics(
+        prefix=config.prefix,
+        exporter=StatsdExporter(config.statsd_host, config.statsd_port) if config.statsd_host else None,
+        export_interval=config.export_interval,
+    )
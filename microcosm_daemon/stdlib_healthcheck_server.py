@@ -0,0 +1,120 @@
+"""
+Healthcheck server built on the standard library.
+
+Serves the same endpoints as `healthcheck_server` without importing Flask or waitress,
+keeping the master process small and quick to start.
+
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from logging import getLogger
+from re import compile as re_compile
+from typing import Optional
+
+from microcosm_daemon.heartbeat import HeartbeatTable
+from microcosm_daemon.sampling_profiler import PROFILE_SIGNAL
+from microcosm_daemon.worker_registry import WorkerRegistry
+
+
+logger = getLogger("daemon.healthcheck_server")
+
+PROFILE_PATH = re_compile(r"^/api/workers/(\d+)/profile$")
+
+
+class HealthcheckHandler(BaseHTTPRequestHandler):
+    # requests are served one at a time; do not let a stalled client hold the server
+    timeout = 5.0
+
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == "/api/health":
+            self.respond(*registry.health())
+        elif self.path == "/api/workers":
+            self.respond(dict(workers=registry.workers()), 200)
+        else:
+            self.respond(dict(), 404)
+
+    def do_POST(self):
+        profile = PROFILE_PATH.match(self.path)
+        if profile is not None:
+            # workers with a sampling profiler start a profile; others ignore the signal
+            found = self.server.registry.signal_worker(int(profile.group(1)), PROFILE_SIGNAL)
+            self.respond(dict(), 202 if found else 404)
+            return
+
+        if self.path != "/api/heartbeat":
+            self.respond(dict(), 404)
+            return
+
+        try:
+            req_data = loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            pid = int(req_data.get("pid"))
+        except (AttributeError, TypeError, ValueError):
+            self.respond(dict(), 400)
+            return
+
+        if not pid:
+            self.respond(dict(), 400)
+            return
+
+        logger.debug(
+            "Received heartbeat from {pid}",
+            extra=dict(pid=pid),
+        )
+        self.server.registry.record(
+            pid,
+            slot=req_data.get("slot"),
+        )
+        self.respond(dict(), 201)
+
+    def respond(self, body, status):
+        content = dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class HealthcheckServer(HTTPServer):
+
+    def __init__(self, address, registry):
+        super().__init__(address, HealthcheckHandler)
+        self.registry = registry
+
+
+def create_server(
+    processes: int,
+    heartbeat_threshold_seconds: int,
+    healthcheck_host: str,
+    healthcheck_port: int,
+    heartbeat_table: Optional[HeartbeatTable] = None,
+    registry: Optional[WorkerRegistry] = None,
+):
+    if registry is None:
+        registry = WorkerRegistry(processes, heartbeat_threshold_seconds, heartbeat_table)
+    return HealthcheckServer((healthcheck_host, healthcheck_port), registry)
+
+
+def run(
+    processes: int,
+    heartbeat_threshold_seconds: int,
+    healthcheck_host: str,
+    healthcheck_port: int,
+    heartbeat_table: Optional[HeartbeatTable] = None,
+    **kwargs,
+):
+    server = create_server(
+        processes,
+        heartbeat_threshold_seconds,
+        healthcheck_host,
+        healthcheck_port,
+        heartbeat_table,
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,152 @@
+"""
+Async state machine tests.
+
+"""
+from asyncio import new_event_loop, sleep
+from copy import copy
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    is_,
+    raises,
+)
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.async_state_machine import AsyncStateMachine, run_concurrently
+from microcosm_daemon.error_policy import FatalError
+from microcosm_daemon.sleep_policy import SleepNow
+
+
+def run(coroutine):
+    loop = new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_step_to_same_func():
+    """
+    Test taking a step to the same coroutine.
+
+    """
+    graph = create_object_graph("example", testing=True)
+
+    async def func(graph):
+        pass
+
+    state_machine = AsyncStateMachine(graph, initial_state=func)
+    next_func = run(state_machine.step())
+    assert_that(next_func, is_(equal_to(func)))
+
+
+def test_step_to_different_func():
+    """
+    Test taking a step from a coroutine to a plain function.
+
+    """
+    graph = create_object_graph("example", testing=True)
+
+    async def func1(graph):
+        return func2
+
+    def func2(graph):
+        pass
+
+    state_machine = AsyncStateMachine(graph, initial_state=func1)
+    next_func = run(state_machine.step())
+    assert_that(next_func, is_(equal_to(func2)))
+
+
+def test_step_to_sleep():
+    """
+    Test taking a step to sleep.
+
+    """
+    graph = create_object_graph("example", testing=True)
+
+    async def func(graph):
+        raise SleepNow()
+
+    state_machine = AsyncStateMachine(graph, initial_state=func)
+    with patch.object(graph.sleep_policy, "async_sleep") as mocked_sleep:
+        next_func = run(state_machine.step())
+
+    assert_that(mocked_sleep.call_count, is_(equal_to(1)))
+    assert_that(next_func, is_(equal_to(func)))
+
+
+def test_step_to_error_non_strict():
+    """
+    Test taking a step to an error.
+
+    """
+    graph = create_object_graph("example", testing=True)
+
+    async def func(graph):
+        raise Exception()
+
+    state_machine = AsyncStateMachine(graph, initial_state=func)
+    next_func = run(state_machine.step())
+    assert_that(next_func, is_(equal_to(func)))
+
+
+def test_step_to_fatal_non_strict():
+    """
+    Test taking a step to a fatal error.
+
+    """
+    graph = create_object_graph("example", testing=True)
+
+    async def func(graph):
+        raise FatalError()
+
+    state_machine = AsyncStateMachine(graph, initial_state=func)
+    assert_that(calling(run).with_args(state_machine.step()), raises(FatalError))
+
+
+def test_run_until_fatal_error():
+    """
+    Running the state machine terminates on fatal error.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    calls = []
+
+    async def func(graph):
+        calls.append(graph)
+        if len(calls) > 2:
+            raise FatalError()
+
+    state_machine = AsyncStateMachine(graph, initial_state=func)
+    state_machine.run()
+    assert_that(len(calls), is_(equal_to(3)))
+
+
+def test_run_concurrently():
+    """
+    Concurrent state machines interleave on one event loop and stop together.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    steps = []
+
+    def make_state(name, count):
+        async def state(graph):
+            steps.append(name)
+            await sleep(0)
+            if steps.count(name) >= count:
+                raise FatalError()
+        return state
+
+    state_machines = [
+        AsyncStateMachine(graph, make_state("a", 3), error_policy=copy(graph.error_policy)),
+        AsyncStateMachine(graph, make_state("b", 100), error_policy=copy(graph.error_policy)),
+    ]
+    run_concurrently(state_machines)
+
+    assert_that(steps[:4], is_(equal_to(["a", "b", "a", "b"])))
+    assert_that(graph.signal_handler.interrupted, is_(equal_to(True)))
@@ -0,0 +1,93 @@
+"""
+Autoscaler tests.
+
+"""
+from hamcrest import (
+    assert_that,
+    close_to,
+    equal_to,
+    is_,
+    none,
+)
+
+from microcosm_daemon.autoscaler import Autoscaler
+from microcosm_daemon.heartbeat import HeartbeatTable
+
+
+def test_observe_idle_ratio():
+    """
+    The idle ratio covers steps taken since the last observation.
+
+    """
+    autoscaler = Autoscaler(min_processes=1, max_processes=4)
+    table = HeartbeatTable(2)
+
+    assert_that(autoscaler.observe(table, [0, 1]), is_(none()))
+
+    table.beat(0, steps=10, sleeps=10)
+    table.beat(1, steps=10, sleeps=0)
+    assert_that(autoscaler.observe(table, [0, 1]), is_(close_to(0.5, 0.001)))
+
+    table.beat(0, steps=20, sleeps=20)
+    table.beat(1, steps=20, sleeps=10)
+    assert_that(autoscaler.observe(table, [0, 1]), is_(close_to(1.0, 0.001)))
+
+
+def test_observe_replaced_worker():
+    """
+    Counters that go backwards belong to a new worker.
+
+    """
+    autoscaler = Autoscaler(min_processes=1, max_processes=4)
+    table = HeartbeatTable(1)
+
+    table.beat(0, steps=100, sleeps=0)
+    autoscaler.observe(table, [0])
+
+    table.beat(0, steps=4, sleeps=4)
+    assert_that(autoscaler.observe(table, [0]), is_(close_to(1.0, 0.001)))
+
+
+def test_desired_processes():
+    autoscaler = Autoscaler(min_processes=1, max_processes=3)
+
+    assert_that(autoscaler.desired_processes(2, None), is_(equal_to(2)))
+    assert_that(autoscaler.desired_processes(2, 0.0), is_(equal_to(3)))
+    assert_that(autoscaler.desired_processes(3, 0.0), is_(equal_to(3)))
+    assert_that(autoscaler.desired_processes(2, 0.5), is_(equal_to(2)))
+    assert_that(autoscaler.desired_processes(2, 1.0), is_(equal_to(1)))
+    assert_that(autoscaler.desired_processes(1, 1.0), is_(equal_to(1)))
+
+
+def test_desired_processes_with_backlog():
+    """
+    A backlog larger than the current workers can handle adds a worker.
+
+    """
+    autoscaler = Autoscaler(
+        min_processes=1,
+        max_processes=3,
+        backlog_probe=lambda: 20,
+        backlog_per_process=10,
+    )
+
+    assert_that(autoscaler.desired_processes(1, 1.0), is_(equal_to(2)))
+    assert_that(autoscaler.desired_processes(2, 1.0), is_(equal_to(1)))
+
+
+def test_desired_processes_with_failing_backlog_probe():
+    """
+    A failing backlog probe is treated as an unknown backlog.
+
+    """
+    def probe():
+        raise ConnectionError("queue unavailable")
+
+    autoscaler = Autoscaler(
+        min_processes=1,
+        max_processes=3,
+        backlog_probe=probe,
+    )
+
+    assert_that(autoscaler.probe_backlog(), is_(none()))
+    assert_that(autoscaler.desired_processes(2, 0.5), is_(equal_to(2)))
@@ -2,10 +2,21 @@
 Test daemon loading.
 
 """
+from argparse import Namespace
+from pickle import dumps, loads
+from unittest.mock import patch
 
-from hamcrest import assert_that, equal_to, is_
+from hamcrest import (
+    assert_that,
+    contains_string,
+    equal_to,
+    is_,
+    none,
+    not_,
+)
 
 from microcosm_daemon.daemon import Daemon
+from microcosm_daemon.startup_profile import StartupProfile
 
 
 class FixtureDaemon(Daemon):
@@ -29,3 +40,132 @@ def test_daemon_initialize():
     assert_that(daemon.graph.hello_world, is_(equal_to("hello world")))
     assert_that(daemon.name, is_(equal_to("fixture")))
     assert_that(str(daemon), is_(equal_to("fixture_daemon")))
+
+
+class MinimalDaemon(FixtureDaemon):
+
+    @property
+    def components(self):
+        return [
+            "hello_world",
+        ]
+
+
+def initialize_and_report(daemon):
+    """
+    Initialize a daemon, returning its startup profile report.
+
+    """
+    with patch("microcosm_daemon.startup_profile.logger") as mock_logger:
+        daemon.initialize()
+
+    mock_logger.info.assert_called_once()
+    return mock_logger.info.call_args[0][2]
+
+
+def test_daemon_profile_startup():
+    """
+    Initializing reuses parsed arguments and reports the time spent on each component.
+
+    """
+    daemon = MinimalDaemon()
+    daemon.args = Namespace(debug=False, testing=True, profile_startup=True)
+    daemon.startup_profile = StartupProfile()
+    report = initialize_and_report(daemon)
+
+    assert_that(daemon.graph.hello_world, is_(equal_to("hello world")))
+    assert_that(daemon.startup_profile, is_(none()))
+    assert_that(report, contains_string("create_object_graph"))
+    assert_that(report, contains_string("component: hello_world"))
+
+
+def test_daemon_pickles_arguments():
+    """
+    Workers inherit the parsed arguments, but not the object graph.
+
+    """
+    daemon = MinimalDaemon()
+    daemon.args = Namespace(debug=False, testing=True)
+    daemon.initialize()
+
+    worker = loads(dumps(daemon))
+    assert_that(worker.args, is_(equal_to(daemon.args)))
+    assert_that(worker.graph, is_(none()))
+
+
+class LazyDaemon(MinimalDaemon):
+
+    @property
+    def lazy_components(self):
+        return [
+            "hello_world",
+        ]
+
+
+def test_daemon_lazy_components():
+    """
+    Lazy components are built on first use, and reported per factory when profiling.
+
+    """
+    daemon = LazyDaemon()
+    daemon.args = Namespace(debug=False, testing=True)
+    daemon.startup_profile = StartupProfile()
+    report = initialize_and_report(daemon)
+
+    assert_that(report, is_(not_(contains_string("hello_world"))))
+    assert_that(daemon.graph.hello_world, is_(equal_to("hello world")))
+
+
+def test_daemon_profiles_factories():
+    daemon = MinimalDaemon()
+    daemon.args = Namespace(debug=False, testing=True)
+    daemon.startup_profile = StartupProfile()
+    report = initialize_and_report(daemon)
+
+    assert_that(report, contains_string("  hello_world  "))
+
+
+def test_daemon_supervises_single_process():
+    """
+    A supervised (or preforked) daemon runs its worker under a master even without heartbeats.
+
+    """
+    for flag in ("--supervise", "--prefork"):
+        daemon = MinimalDaemon()
+        with patch("sys.argv", ["minimal", flag]):
+            with patch("microcosm_daemon.daemon.ProcessRunner") as mocked_process_runner:
+                with patch("microcosm_daemon.daemon.SimpleRunner") as mocked_simple_runner:
+                    daemon.run()
+
+        mocked_process_runner.return_value.run.assert_called_once_with()
+        mocked_simple_runner.assert_not_called()
+
+
+class ProcessWorkQueueDaemon(FixtureDaemon):
+
+    @property
+    def components(self):
+        return [
+            "work_queue",
+        ]
+
+    @property
+    def defaults(self):
+        return dict(
+            work_queue=dict(
+                processes=True,
+            ),
+        )
+
+
+def test_daemon_supervises_process_work_queues():
+    """
+    Workers that start a process pool run under a supervisor (as pool workers may not).
+
+    """
+    daemon = ProcessWorkQueueDaemon()
+    with patch("sys.argv", ["process_work_queue", "--processes", "2"]):
+        with patch("microcosm_daemon.daemon.ProcessRunner") as mocked_process_runner:
+            daemon.run()
+
+    assert_that(mocked_process_runner.call_args[1]["supervise"], is_(equal_to(True)))
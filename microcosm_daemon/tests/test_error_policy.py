@@ -2,17 +2,29 @@
 Error policy tests.
 
 """
+from unittest.mock import patch
+
 from hamcrest import (
     assert_that,
     calling,
     contains,
     equal_to,
     is_,
+    none,
     raises,
+    same_instance,
 )
 from microcosm.api import create_object_graph
 
-from microcosm_daemon.error_policy import ErrorPolicy, FatalError
+from microcosm_daemon.error_policy import (
+    HEALTH_ERROR,
+    HEALTH_OK,
+    HEALTH_WARN,
+    CircuitBreaker,
+    ErrorPolicy,
+    ErrorWindow,
+    FatalError,
+)
 from microcosm_daemon.health_reporter import HealthReporter
 
 
@@ -110,3 +122,120 @@ def test_fatal_strict():
 
     assert_that(calling(defer), raises(FatalError))
     assert_that(error_policy.errors, contains(error))
+
+
+def test_error_window():
+    """
+    Errors expire once they fall out of the window.
+
+    """
+    error_window = ErrorWindow(window_seconds=10.0)
+
+    error_window.record(100.0)
+    error_window.record(105.0)
+    assert_that(error_window.total, is_(equal_to(2)))
+
+    error_window.advance(110.5)
+    assert_that(error_window.total, is_(equal_to(1)))
+
+    error_window.advance(1000.0)
+    assert_that(error_window.total, is_(equal_to(0)))
+
+
+def test_health_reflects_error_rate():
+    """
+    Health warns on any recent error and fails on many, then recovers as errors expire.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    error_policy = ErrorPolicy(
+        strict=False,
+        health_report_interval=3.0,
+        health_reporter=HealthReporter(graph),
+        error_window_seconds=10.0,
+        warn_threshold=1,
+        error_threshold=3,
+    )
+
+    def step(now, error=None):
+        with patch("microcosm_daemon.error_policy.monotonic", return_value=now):
+            with error_policy:
+                if error:
+                    raise error
+        return error_policy.health
+
+    assert_that(step(100.0), is_(equal_to(HEALTH_OK)))
+    assert_that(step(101.0, Exception()), is_(equal_to(HEALTH_WARN)))
+    assert_that(step(102.0), is_(equal_to(HEALTH_WARN)))
+    assert_that(step(103.0, Exception()), is_(equal_to(HEALTH_WARN)))
+    assert_that(step(104.0, Exception()), is_(equal_to(HEALTH_ERROR)))
+    assert_that(step(112.0), is_(equal_to(HEALTH_WARN)))
+    assert_that(step(115.0), is_(equal_to(HEALTH_OK)))
+
+
+def test_steady_state_does_not_allocate_errors():
+    """
+    Steps without errors reuse the (empty) errors list and skip health computation.
+
+    """
+    error_policy = new_error_policy(strict=False)
+    with error_policy:
+        pass
+    errors = error_policy.errors
+
+    with patch.object(error_policy, "maybe_report_health") as mocked:
+        with error_policy:
+            pass
+
+    assert_that(error_policy.errors, is_(same_instance(errors)))
+    assert_that(mocked.called, is_(equal_to(False)))
+
+
+def test_circuit_breaker_opens_and_closes():
+    """
+    Consecutive errors of the same class open the circuit, which closes after a trial step.
+
+    """
+    circuit_breaker = CircuitBreaker(threshold=3, min_backoff=1.0, max_backoff=3.0)
+
+    assert_that(circuit_breaker.on_error(KeyError), is_(none()))
+    assert_that(circuit_breaker.on_error(ValueError), is_(none()))
+    assert_that(circuit_breaker.on_error(ValueError), is_(none()))
+    assert_that(circuit_breaker.on_error(ValueError), is_(equal_to(1.0)))
+    assert_that(circuit_breaker.state, is_(equal_to(CircuitBreaker.OPEN)))
+
+    with patch.object(circuit_breaker.sleep_policy, "sleep"):
+        circuit_breaker.sleep(1.0)
+    assert_that(circuit_breaker.state, is_(equal_to(CircuitBreaker.HALF_OPEN)))
+
+    # a failed trial reopens the circuit with a longer backoff
+    assert_that(circuit_breaker.on_error(ValueError), is_(equal_to(2.0)))
+    circuit_breaker.state = CircuitBreaker.HALF_OPEN
+    assert_that(circuit_breaker.on_error(ValueError), is_(equal_to(3.0)))
+    circuit_breaker.state = CircuitBreaker.HALF_OPEN
+
+    circuit_breaker.on_success()
+    assert_that(circuit_breaker.state, is_(equal_to(CircuitBreaker.CLOSED)))
+    assert_that(circuit_breaker.on_error(ValueError), is_(none()))
+
+
+def test_error_policy_with_circuit_breaker():
+    """
+    A non-strict error policy backs off once the circuit opens.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    error_policy = ErrorPolicy(
+        strict=False,
+        health_report_interval=3.0,
+        health_reporter=HealthReporter(graph),
+        circuit_breaker=CircuitBreaker(threshold=2, min_backoff=5.0),
+    )
+
+    with patch.object(error_policy.circuit_breaker.sleep_policy, "sleep") as mocked_sleep:
+        for _ in range(2):
+            with error_policy:
+                raise Exception()
+
+    mocked_sleep.assert_called_once_with(5.0)
+    assert_that(error_policy.circuit_breaker.state, is_(equal_to(CircuitBreaker.HALF_OPEN)))
@@ -0,0 +1,160 @@
+"""
+Health reporter tests.
+
+"""
+from threading import Barrier, Thread
+from time import sleep
+from unittest.mock import Mock, patch
+
+from hamcrest import assert_that, equal_to, is_
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.error_policy import ErrorPolicy
+from microcosm_daemon.health_reporter import ErrorLog, HealthReporter, HeartbeatSender
+
+
+def new_heartbeat_sender():
+    return HeartbeatSender(
+        url="http://localhost/api/heartbeat",
+        timeout=1,
+    )
+
+
+def test_send_coalesces():
+    """
+    A pending heartbeat is replaced by the latest one.
+
+    """
+    sender = new_heartbeat_sender()
+
+    with patch.object(sender, "ensure_started"):
+        sender.send(1)
+        sender.send(1)
+        sender.send(1, slot=0)
+
+    assert_that(sender.pending, is_(equal_to(dict(pid=1, slot=0))))
+    assert_that(sender.coalesced, is_(equal_to(2)))
+
+
+def test_send_posts_in_background():
+    """
+    Heartbeats are posted by the background thread over a pooled session.
+
+    """
+    sender = new_heartbeat_sender()
+    session = Mock()
+
+    with patch("microcosm_daemon.health_reporter.requests") as mocked_requests:
+        mocked_requests.Session.return_value = session
+        sender.send(1)
+
+    for _ in range(100):
+        if sender.sent:
+            break
+        sleep(0.01)
+
+    assert_that(sender.sent, is_(equal_to(1)))
+    session.post.assert_called_once_with(
+        "http://localhost/api/heartbeat",
+        json=dict(pid=1),
+        timeout=1,
+    )
+
+
+def test_ensure_started_once_across_threads():
+    """
+    Concurrent senders (e.g. thread runner lanes) start a single sender thread.
+
+    """
+    sender = new_heartbeat_sender()
+    barrier = Barrier(8)
+
+    def send():
+        barrier.wait()
+        sender.ensure_started()
+
+    with patch("microcosm_daemon.health_reporter.requests") as mocked_requests:
+        with patch("microcosm_daemon.health_reporter.Thread") as mocked_thread:
+            threads = [Thread(target=send) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    assert_that(mocked_requests.Session.call_count, is_(equal_to(1)))
+    assert_that(mocked_thread.return_value.start.call_count, is_(equal_to(1)))
+
+
+def test_error_log_deduplicates():
+    """
+    Repeated errors log one traceback and are then summarized with counts.
+
+    """
+    error_log = ErrorLog(interval=60.0)
+
+    with patch("microcosm_daemon.health_reporter.logger") as mocked_logger:
+        error_log.log(ValueError("no such id: 1"), now=0.0)
+        error_log.log(ValueError("no such id: 2"), now=1.0)
+        error_log.log(ValueError("no such id: 3"), now=2.0)
+        error_log.log(KeyError("other"), now=3.0)
+
+        assert_that(mocked_logger.exception.call_count, is_(equal_to(2)))
+        assert_that(mocked_logger.warning.call_count, is_(equal_to(0)))
+
+        error_log.log(ValueError("no such id: 4"), now=61.0)
+
+    assert_that(mocked_logger.warning.call_count, is_(equal_to(1)))
+    assert_that(mocked_logger.warning.call_args[0][1:], is_(equal_to((2, "ValueError: no such id: N"))))
+    # a new interval logs a traceback again
+    assert_that(mocked_logger.exception.call_count, is_(equal_to(3)))
+
+
+def test_error_log_bounds_fingerprints():
+    """
+    Errors beyond the fingerprint limit are counted together.
+
+    """
+    error_log = ErrorLog(interval=60.0, max_fingerprints=1)
+
+    with patch("microcosm_daemon.health_reporter.logger") as mocked_logger:
+        error_log.log(ValueError(), now=0.0)
+        error_log.log(KeyError(), now=0.0)
+        error_log.log(TypeError(), now=0.0)
+
+    assert_that(mocked_logger.exception.call_count, is_(equal_to(1)))
+    assert_that(error_log.repeats[ErrorLog.OTHER], is_(equal_to(2)))
+
+
+def test_error_log_summarizes_without_new_errors():
+    """
+    Repeats are summarized once the interval elapses, even if errors have stopped.
+
+    """
+    error_log = ErrorLog(interval=60.0)
+
+    with patch("microcosm_daemon.health_reporter.logger") as mocked_logger:
+        error_log.log(ValueError(), now=0.0)
+        error_log.log(ValueError(), now=1.0)
+        error_log.maybe_summarize(now=30.0)
+        assert_that(mocked_logger.warning.call_count, is_(equal_to(0)))
+
+        error_log.maybe_summarize(now=61.0)
+
+    assert_that(mocked_logger.warning.call_count, is_(equal_to(1)))
+
+
+def test_error_policy_logs_every_error():
+    """
+    Every error is counted, not only the errors of steps that report health.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    health_reporter = HealthReporter(graph)
+    error_policy = ErrorPolicy(strict=False, health_report_interval=3.0, health_reporter=health_reporter)
+
+    with patch("microcosm_daemon.health_reporter.logger"):
+        for _ in range(100):
+            with error_policy:
+                raise ValueError("down")
+
+    assert_that(health_reporter.error_log.repeats, is_(equal_to({"ValueError: down": 99})))
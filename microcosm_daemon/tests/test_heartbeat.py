@@ -0,0 +1,211 @@
+"""
+Heartbeat table tests.
+
+"""
+from copy import copy
+from os import getpid
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    contains_inanyorder,
+    equal_to,
+    has_length,
+    is_,
+    less_than,
+    none,
+)
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.async_state_machine import AsyncStateMachine
+from microcosm_daemon.health_reporter import HealthReporter
+from microcosm_daemon.healthcheck_server import create_app
+from microcosm_daemon.heartbeat import (
+    HeartbeatTable,
+    attach_heartbeat_table,
+    claim_heartbeat_slot,
+    get_heartbeat_slot,
+)
+from microcosm_daemon.state_machine import StateMachine
+from microcosm_daemon.worker_registry import WorkerRegistry
+
+
+def test_empty_table():
+    """
+    Unwritten slots are not reported.
+
+    """
+    table = HeartbeatTable(2)
+    assert_that(table.ages(), is_(equal_to({})))
+
+
+def test_beat():
+    """
+    Each slot reports its own pid and age.
+
+    """
+    table = HeartbeatTable(2)
+    table.beat(0, pid=100)
+    table.beat(1, pid=101)
+
+    ages = table.ages()
+    assert_that(list(ages.keys()), contains_inanyorder(100, 101))
+    assert_that(ages[100], is_(less_than(1.0)))
+
+
+def test_health_reporter_uses_slot():
+    """
+    Health reports write to the claimed slot instead of posting over HTTP.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    table = HeartbeatTable(1)
+    attach_heartbeat_table(table)
+    claim_heartbeat_slot(0)
+
+    try:
+        with patch("microcosm_daemon.health_reporter.requests") as mocked_requests:
+            HealthReporter(graph)(0, 0, [])
+
+        assert_that(mocked_requests.post.call_count, is_(equal_to(0)))
+        assert_that(list(table.ages().keys()), is_(equal_to([getpid()])))
+    finally:
+        attach_heartbeat_table(None)
+        claim_heartbeat_slot(None)
+
+    assert_that(get_heartbeat_slot(), is_(none()))
+
+
+def test_heartbeat_counts_steps_of_each_state_machine():
+    """
+    Concurrent state machines with their own sleep policies all count towards idleness.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    table = HeartbeatTable(1)
+    attach_heartbeat_table(table)
+    claim_heartbeat_slot(0)
+
+    def func(graph):
+        return None
+
+    try:
+        state_machines = [
+            AsyncStateMachine(graph, func, sleep_policy=copy(graph.sleep_policy))
+            for _ in range(2)
+        ]
+        for steps, sleeps, state_machine in zip((3, 5), (1, 2), state_machines):
+            state_machine.sleep_policy.steps = steps
+            state_machine.sleep_policy.sleeps = sleeps
+
+        with patch("microcosm_daemon.health_reporter.requests"):
+            HealthReporter(graph)(0, 0, [])
+    finally:
+        attach_heartbeat_table(None)
+        claim_heartbeat_slot(None)
+
+    assert_that(table.steps[0], is_(equal_to(8)))
+    assert_that(table.sleeps[0], is_(equal_to(3)))
+
+
+def test_healthcheck_reads_table():
+    """
+    The healthcheck endpoint reads heartbeats from the table.
+
+    """
+    table = HeartbeatTable(2)
+    registry = WorkerRegistry(2, 2, heartbeat_table=table, cache_seconds=0.0)
+    client = create_app(2, 2, registry=registry).test_client()
+
+    assert_that(client.get("/api/health").status_code, is_(equal_to(500)))
+
+    table.beat(0, pid=100)
+    assert_that(client.get("/api/health").status_code, is_(equal_to(500)))
+
+    table.beat(1, pid=101)
+    response = client.get("/api/health")
+    assert_that(response.status_code, is_(equal_to(200)))
+    assert_that(response.json["heartbeats"], has_length(2))
+
+
+def test_worker_registry_replaces_restarted_worker():
+    """
+    A heartbeat from a new pid in a known slot replaces the old pid.
+
+    """
+    registry = WorkerRegistry(2, 2, cache_seconds=0.0)
+    registry.record(100, slot=0, now=0.0)
+    registry.record(101, slot=1, now=0.0)
+    registry.record(102, slot=0, now=1.0)
+
+    body, status = registry.health(now=1.0)
+    assert_that(status, is_(equal_to(200)))
+    assert_that(sorted(body["heartbeats"]), is_(equal_to(["101", "102"])))
+
+
+def test_worker_registry_expires_heartbeats():
+    """
+    Heartbeats that are not renewed are reported as stale, then forgotten.
+
+    """
+    registry = WorkerRegistry(1, 2, expiry_seconds=10.0, cache_seconds=0.0)
+    registry.record(100, now=0.0)
+
+    assert_that(registry.health(now=1.0)[1], is_(equal_to(200)))
+    assert_that(registry.health(now=5.0)[1], is_(equal_to(500)))
+    assert_that(registry.workers(now=11.0), is_(equal_to([])))
+    assert_that(registry.health(now=11.0), is_(equal_to(({}, 500))))
+
+
+def test_worker_registry_caches_verdict():
+    registry = WorkerRegistry(1, 10, cache_seconds=5.0)
+
+    assert_that(registry.health(now=0.0)[1], is_(equal_to(500)))
+    registry.record(100, now=1.0)
+    assert_that(registry.health(now=1.0)[1], is_(equal_to(500)))
+    assert_that(registry.health(now=5.0)[1], is_(equal_to(200)))
+
+
+def test_workers_endpoint_reports_last_step():
+    """
+    Workers report the latency and state of their last step through their slot.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    table = HeartbeatTable(2)
+    attach_heartbeat_table(table)
+    claim_heartbeat_slot(1)
+
+    def func(graph):
+        return None
+
+    try:
+        state_machine = StateMachine(graph, initial_state=func)
+        state_machine.advance()
+        get_heartbeat_slot()(steps=1)
+    finally:
+        attach_heartbeat_table(None)
+        claim_heartbeat_slot(None)
+
+    response = create_app(2, 2, heartbeat_table=table).test_client().get("/api/workers")
+    [worker] = response.json["workers"]
+    assert_that(worker["slot"], is_(equal_to(1)))
+    assert_that(worker["pid"], is_(equal_to(getpid())))
+    assert_that(worker["state"], is_(equal_to("test_workers_endpoint_reports_last_step.<locals>.func")))
+    assert_that(worker["latency"], is_(less_than(1.0)))
+
+
+def test_profile_endpoint_signals_worker():
+    """
+    Profiles are requested per worker slot.
+
+    """
+    registry = WorkerRegistry(1, 2)
+    registry.record(100, slot=0)
+    client = create_app(1, 2, registry=registry).test_client()
+
+    with patch("microcosm_daemon.worker_registry.kill") as mock_kill:
+        assert_that(client.post("/api/workers/0/profile").status_code, is_(equal_to(202)))
+        assert_that(client.post("/api/workers/1/profile").status_code, is_(equal_to(404)))
+
+    assert_that(mock_kill.call_count, is_(equal_to(1)))
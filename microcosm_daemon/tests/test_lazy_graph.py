@@ -0,0 +1,86 @@
+"""
+Lazy component tests.
+
+"""
+from threading import Barrier, Thread
+from time import sleep
+from typing import List
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    has_length,
+    is_,
+    raises,
+)
+from microcosm.api import binding, create_object_graph
+from microcosm.errors import LockedGraphError
+
+from microcosm_daemon.lazy_graph import use_lazily
+
+
+BUILT: List[str] = []
+
+
+@binding("lazy_fixture_dependency")
+def configure_lazy_fixture_dependency(graph):
+    BUILT.append("lazy_fixture_dependency")
+    return "dependency"
+
+
+@binding("lazy_fixture")
+def configure_lazy_fixture(graph):
+    BUILT.append("lazy_fixture")
+    # give concurrent accessors a chance to race
+    sleep(0.01)
+    return dict(dependency=graph.lazy_fixture_dependency)
+
+
+def new_graph():
+    del BUILT[:]
+    graph = create_object_graph("example", testing=True)
+    use_lazily(graph, ["lazy_fixture"])
+    graph.use("hello_world")
+    graph.lock()
+    return graph
+
+
+def test_lazy_component():
+    """
+    Lazy components (and their dependencies) are built on first access once locked.
+
+    """
+    graph = new_graph()
+    assert_that(BUILT, is_(equal_to([])))
+
+    assert_that(graph.lazy_fixture, is_(equal_to(dict(dependency="dependency"))))
+    assert_that(BUILT, is_(equal_to(["lazy_fixture", "lazy_fixture_dependency"])))
+    assert_that(graph.lazy_fixture, is_(equal_to(dict(dependency="dependency"))))
+    assert_that(BUILT, has_length(2))
+
+
+def test_other_components_stay_locked():
+    graph = new_graph()
+
+    assert_that(calling(getattr).with_args(graph, "lazy_fixture_dependency"), raises(LockedGraphError))
+    assert_that(graph.hello_world, is_(equal_to("hello world")))
+
+
+def test_lazy_component_is_built_once_across_threads():
+    graph = new_graph()
+    barrier = Barrier(4)
+    components = []
+
+    def access():
+        barrier.wait()
+        components.append(graph.lazy_fixture)
+
+    threads = [Thread(target=access) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_that(BUILT.count("lazy_fixture"), is_(equal_to(1)))
+    assert_that(all(component is components[0] for component in components), is_(equal_to(True)))
@@ -0,0 +1,127 @@
+"""
+Prefetching state tests.
+
+"""
+from threading import get_ident
+from time import sleep
+
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    equal_to,
+    has_length,
+    instance_of,
+    is_,
+    is_not,
+)
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.api import SleepNow, prefetch
+from microcosm_daemon.heartbeat import state_name
+from microcosm_daemon.prefetch import Pipeline
+from microcosm_daemon.state_machine import StateMachine
+
+
+class Source:
+
+    def __init__(self, *items):
+        self.items = list(items)
+        self.threads = []
+
+    def fetch(self, graph):
+        self.threads.append(get_ident())
+        if not self.items:
+            raise SleepNow()
+        item = self.items.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def create_state_machine(source, processed, **kwargs):
+    graph = create_object_graph("example", testing=True)
+    graph.sleep_policy.default_sleep_timeout = 0.01
+
+    @prefetch(source.fetch)
+    def process(graph, item):
+        processed.append(item)
+
+    return StateMachine(graph, process, **kwargs)
+
+
+def advance_until(state_machine, condition, steps=100):
+    for _ in range(steps):
+        if condition():
+            return
+        state_machine.advance()
+
+
+def test_fetch_in_line():
+    """
+    Without a pipeline, a prefetching state fetches and then processes.
+
+    """
+    source = Source(1, 2)
+    processed = []
+    state_machine = create_state_machine(source, processed)
+
+    state_machine.advance()
+    state_machine.advance()
+
+    assert_that(processed, contains_exactly(1, 2))
+    assert_that(set(source.threads), is_(equal_to({get_ident()})))
+
+
+def test_fetch_ahead():
+    """
+    With a pipeline, fetches run ahead in a background thread.
+
+    """
+    source = Source(1, 2, 3)
+    processed = []
+    state_machine = create_state_machine(source, processed, pipeline_depth=2)
+    assert_that(state_machine.current_state, is_(instance_of(Pipeline)))
+    assert_that(state_name(state_machine.current_state), is_(equal_to("create_state_machine.<locals>.process")))
+
+    try:
+        advance_until(state_machine, lambda: len(processed) == 3)
+    finally:
+        state_machine.stop_pipelines()
+
+    assert_that(processed, contains_exactly(1, 2, 3))
+    assert_that(source.threads[0], is_not(equal_to(get_ident())))
+
+
+def test_pipeline_depth():
+    """
+    No more than `pipeline_depth` results are fetched ahead.
+
+    """
+    source = Source(1, 2, 3, 4)
+    processed = []
+    state_machine = create_state_machine(source, processed, pipeline_depth=1)
+
+    try:
+        advance_until(state_machine, lambda: processed)
+        sleep(0.05)
+        # one result is fetched ahead; the next fetch waits for room
+        assert_that(source.threads, has_length(len(processed) + 1))
+    finally:
+        state_machine.stop_pipelines()
+
+
+def test_fetch_errors_are_raised_by_the_state():
+    source = Source(Exception("fetch failed"), 1)
+    processed = []
+    state_machine = create_state_machine(source, processed, pipeline_depth=1)
+
+    try:
+        advance_until(state_machine, lambda: state_machine.error_policy.errors)
+        [error] = state_machine.error_policy.errors
+        assert_that(str(error), is_(equal_to("fetch failed")))
+
+        advance_until(state_machine, lambda: processed)
+    finally:
+        state_machine.stop_pipelines()
+
+    assert_that(processed, contains_exactly(1))
@@ -0,0 +1,67 @@
+"""
+Reloader tests.
+
+"""
+import os
+from time import sleep
+
+from hamcrest import (
+    assert_that,
+    equal_to,
+    has_item,
+    is_,
+    is_not,
+    not_none,
+)
+
+from microcosm_daemon.reloader import (
+    InotifyWatcher,
+    PollingWatcher,
+    _iter_user_files,
+    _library_paths,
+)
+
+
+def test_iter_user_files():
+    """
+    Only files outside of the standard library and site-packages are watched.
+
+    """
+    user_files = list(_iter_user_files(_library_paths()))
+
+    assert_that(user_files, has_item(__file__.replace(".pyc", ".py")))
+    assert_that(user_files, is_not(has_item(os.__file__)))
+
+
+def test_inotify_watcher(tmpdir):
+    filename = str(tmpdir.join("module.py"))
+    with open(filename, "w") as outfile:
+        outfile.write("")
+
+    watcher = InotifyWatcher.create()
+    assert_that(watcher, is_(not_none()))
+    watcher.add([filename])
+
+    assert_that(watcher.wait(0.01), is_(equal_to(False)))
+
+    with open(filename, "w") as outfile:
+        outfile.write("changed = True\n")
+
+    assert_that(watcher.wait(1.0), is_(equal_to(True)))
+
+
+def test_polling_watcher(tmpdir):
+    filename = str(tmpdir.join("module.py"))
+    with open(filename, "w") as outfile:
+        outfile.write("")
+
+    watcher = PollingWatcher()
+    watcher.add([filename])
+
+    assert_that(watcher.wait(0.0), is_(equal_to(False)))
+
+    sleep(0.01)
+    with open(filename, "w") as outfile:
+        outfile.write("changed = True\n")
+
+    assert_that(watcher.wait(0.0), is_(equal_to(True)))
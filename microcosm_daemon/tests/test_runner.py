@@ -1,17 +1,36 @@
 import os
-from multiprocessing import Pool
-from signal import SIGINT, SIGTERM
+from multiprocessing import Pool, Process
+from signal import (
+    SIG_DFL,
+    SIG_IGN,
+    SIGINT,
+    SIGTERM,
+    signal,
+)
 from subprocess import Popen
 from threading import Thread
 from time import sleep
 from unittest.mock import Mock, patch
 
-from hamcrest import assert_that, equal_to, has_length
+from hamcrest import (
+    assert_that,
+    equal_to,
+    has_length,
+    is_,
+    not_,
+)
+from microcosm.api import create_object_graph
 from requests import get
 
-from microcosm_daemon.api import SleepNow
+from microcosm_daemon.api import FatalError, SleepNow
 from microcosm_daemon.daemon import Daemon
-from microcosm_daemon.runner import ProcessRunner
+from microcosm_daemon.runner import (
+    ProcessRunner,
+    Supervisor,
+    ThreadRunner,
+    _init_worker,
+    _start_preforked_worker,
+)
 
 
 class FixtureDaemon(Daemon):
@@ -24,6 +43,26 @@ class FixtureDaemon(Daemon):
         raise SleepNow()
 
 
+class LaneDaemon(Daemon):
+
+    @property
+    def name(self):
+        return "lane"
+
+    def initialize(self):
+        self.graph = create_object_graph("example", testing=True)
+
+    def __call__(self, graph):
+        sleep(0.1)
+        raise FatalError()
+
+
+class BacklogDaemon(LaneDaemon):
+
+    def autoscale_backlog(self):
+        return len(self.graph.config)
+
+
 def sleep_and_send_signal(pid, seconds, signum):
     def exec():
         sleep(seconds)
@@ -42,7 +81,8 @@ def test_process_runner_to_terminate_pool_sig_term():
 
 def process_runner_to_terminate_pool(signum):
     daemon = FixtureDaemon()
-    pool = Mock(wraps=Pool(2))
+    # mirror `ProcessRunner.process_pool`
+    pool = Mock(wraps=Pool(2, initializer=_init_worker, initargs=(None,)))
     runner = ProcessRunner(
         daemon,
         2,
@@ -77,6 +117,226 @@ def process_runner_to_terminate_pool(signum):
     pool.terminate.assert_called_once()
 
 
+def test_thread_runner():
+    daemon = LaneDaemon()
+    runner = ThreadRunner(daemon, 3)
+    lanes = []
+
+    def run_lane(graph, lane):
+        lanes.append((lane, id(graph)))
+        ThreadRunner.run_lane(runner, graph, lane)
+
+    terminated = False
+    with patch.object(runner, "run_lane", side_effect=run_lane):
+        with patch("microcosm_daemon.runner.logger") as mocked_logger:
+            try:
+                runner.run()
+            except SystemExit:
+                terminated = True
+
+    assert terminated
+    assert_that(sorted(lane for lane, _ in lanes), is_(equal_to([0, 1, 2])))
+    # all lanes share one graph
+    assert_that(len(set(graph_id for _, graph_id in lanes)), is_(equal_to(1)))
+    assert_that(daemon.graph.signal_handler.interrupted, is_(equal_to(True)))
+    # lanes exiting on `FatalError` are not errors
+    mocked_logger.error.assert_not_called()
+
+
+def test_thread_runner_logs_unexpected_lane_errors():
+    daemon = LaneDaemon()
+    daemon.initialize()
+    runner = ThreadRunner(daemon, 1)
+    error = ValueError("unexpected")
+
+    with patch("microcosm_daemon.runner.StateMachine") as mocked_state_machine:
+        mocked_state_machine.return_value.run_loop.side_effect = error
+        with patch("microcosm_daemon.runner.logger") as mocked_logger:
+            runner.run_lane(daemon.graph, 0)
+
+    mocked_logger.error.assert_called_once_with(
+        "Unexpected error while running thread lane",
+        extra=dict(lane=0, error=error),
+    )
+    assert_that(daemon.graph.signal_handler.interrupted, is_(equal_to(True)))
+
+
+def test_process_runner_prefork():
+    daemon = Mock()
+    runner = ProcessRunner(
+        daemon,
+        2,
+        prefork=True,
+        heartbeat_threshold_seconds=-1,
+        healthcheck_host="0.0.0.0",
+        healthcheck_port=80,
+    )
+
+    with patch.object(runner, "process_pool") as mocked_process_pool:
+        with patch.object(runner, "close"):
+            runner.run()
+
+    # the graph is built once, in the master
+    daemon.initialize.assert_called_once_with()
+    apply_async = mocked_process_pool.return_value.apply_async
+    assert_that(apply_async.call_count, is_(equal_to(2)))
+    func, args = apply_async.call_args[0][:2]
+    assert_that(func, is_(equal_to(_start_preforked_worker)))
+    assert_that(args, is_(equal_to((1,))))
+
+    # workers inherit the initialized target
+    _start_preforked_worker(0)
+    daemon.start_forked.assert_called_once_with()
+    daemon.start.assert_not_called()
+
+
+def test_process_runner_backlog_probe():
+    """
+    An overridden backlog probe gets an object graph in the master process.
+
+    """
+    daemon = BacklogDaemon()
+    runner = ProcessRunner(daemon, 1, max_processes=2, heartbeat_threshold_seconds=-1)
+    autoscaler = runner.process_autoscaler()
+
+    assert_that(daemon.graph, is_(not_(None)))
+    assert_that(autoscaler.probe_backlog(), is_(equal_to(len(daemon.graph.config))))
+
+
+def test_process_runner_default_backlog_probe():
+    daemon = FixtureDaemon()
+    runner = ProcessRunner(daemon, 1, max_processes=2, heartbeat_threshold_seconds=-1)
+    autoscaler = runner.process_autoscaler()
+
+    assert_that(daemon.graph, is_(None))
+    assert_that(autoscaler.probe_backlog(), is_(None))
+
+
+def noop(*args):
+    pass
+
+
+def new_supervisor(processes=2, max_restarts=2):
+    context = Mock()
+    context.Process.side_effect = lambda **kwargs: Mock(exitcode=None)
+    return Supervisor(
+        context=context,
+        worker_func_and_args=lambda slot: (noop, (slot,)),
+        processes=processes,
+        max_restarts=max_restarts,
+        crash_loop_window=60.0,
+        min_backoff=1.0,
+        max_backoff=30.0,
+    )
+
+
+def test_supervisor_restarts_crashed_worker_with_backoff():
+    supervisor = new_supervisor()
+    supervisor.start()
+    first, second = supervisor.workers[0], supervisor.workers[1]
+
+    first.exitcode = 1
+    assert_that(supervisor.check(now=100.0), is_(equal_to(True)))
+    # only the crashed worker is pending a restart
+    assert_that(supervisor.workers, is_(equal_to({1: second})))
+    assert_that(supervisor.pending_restarts, is_(equal_to({0: 101.0})))
+
+    supervisor.check(now=101.0)
+    assert_that(supervisor.workers[0], is_(not_(first)))
+    assert_that(supervisor.restarts[0], is_(equal_to(1)))
+    second.terminate.assert_not_called()
+
+    # a second crash backs off for longer
+    supervisor.workers[0].exitcode = -9
+    supervisor.check(now=102.0)
+    assert_that(supervisor.pending_restarts, is_(equal_to({0: 104.0})))
+
+
+def test_supervisor_starts_non_daemonic_workers():
+    """
+    Supervised workers may start processes of their own (e.g. a process work queue).
+
+    """
+    supervisor = new_supervisor(processes=1)
+    supervisor.start()
+
+    assert_that(supervisor.context.Process.call_args[1]["daemon"], is_(equal_to(False)))
+
+
+def test_supervisor_does_not_restart_clean_exit():
+    supervisor = new_supervisor(processes=1)
+    supervisor.start()
+
+    supervisor.workers[0].exitcode = 0
+    assert_that(supervisor.check(now=100.0), is_(equal_to(False)))
+    assert_that(supervisor.restarts[0], is_(equal_to(0)))
+    assert_that(supervisor.crash_looping, is_(equal_to(False)))
+
+
+def test_supervisor_detects_crash_loop():
+    supervisor = new_supervisor(processes=1, max_restarts=2)
+    supervisor.start()
+
+    now = 100.0
+    for _ in range(2):
+        supervisor.workers[0].exitcode = 1
+        assert_that(supervisor.check(now=now), is_(equal_to(True)))
+        now += 10.0
+        supervisor.check(now=now)
+
+    supervisor.workers[0].exitcode = 1
+    assert_that(supervisor.check(now=now), is_(equal_to(False)))
+    assert_that(supervisor.crash_looping, is_(equal_to(True)))
+    assert_that(supervisor.restarts[0], is_(equal_to(2)))
+
+
+def test_supervisor_scales_workers():
+    supervisor = new_supervisor(processes=1)
+    supervisor.max_processes = 3
+    supervisor.start()
+
+    supervisor.scale(3)
+    assert_that(sorted(supervisor.workers), is_(equal_to([0, 1, 2])))
+
+    retired = supervisor.workers[2]
+    supervisor.scale(2)
+    retired.terminate.assert_called_once_with()
+    assert_that(supervisor.active_slots(), is_(equal_to([0, 1])))
+
+    # a retired worker is not restarted, even if it exits uncleanly
+    retired.exitcode = -15
+    supervisor.check(now=100.0)
+    assert_that(sorted(supervisor.workers), is_(equal_to([0, 1])))
+    assert_that(supervisor.pending_restarts, is_(equal_to({})))
+
+
+def sleep_forever(handler):
+    signal(SIGTERM, handler)
+    while True:
+        sleep(0.1)
+
+
+def test_process_runner_drain():
+    runner = ProcessRunner(
+        Mock(),
+        2,
+        drain_timeout=1.0,
+        heartbeat_threshold_seconds=-1,
+    )
+    graceful = Process(target=sleep_forever, args=(SIG_DFL,))
+    stubborn = Process(target=sleep_forever, args=(SIG_IGN,))
+    graceful.start()
+    stubborn.start()
+    sleep(0.2)
+
+    runner.drain()
+
+    # the graceful worker exited on SIGTERM; the stubborn one was killed at the deadline
+    assert_that(graceful.exitcode, is_(equal_to(-SIGTERM)))
+    stubborn.join(1.0)
+    assert_that(stubborn.exitcode, is_(equal_to(-9)))
+
+
 if __name__ == "__main__":
     daemon = FixtureDaemon()
     daemon.run()
@@ -0,0 +1,97 @@
+"""
+Sampling profiler tests.
+
+"""
+from os import listdir, path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    equal_to,
+    has_item,
+    has_length,
+    is_,
+    none,
+    starts_with,
+)
+
+from microcosm_daemon.sampling_profiler import PROFILE_SIGNAL, SamplingProfiler
+from microcosm_daemon.worker_registry import WorkerRegistry
+
+
+class Worker:
+
+    def __init__(self, profiler):
+        self.current_state = self.waiting
+        self.profiler = profiler
+        self.watching = Event()
+        self.done = Event()
+
+    def waiting(self, graph):
+        return None
+
+    def run(self):
+        self.profiler.watch(self)
+        self.watching.set()
+        self.done.wait()
+
+
+def test_profile_is_tagged_with_state():
+    """
+    Samples of a watched thread are rooted at its state machine's current state.
+
+    """
+    with TemporaryDirectory() as output_dir:
+        profiler = SamplingProfiler("example", interval=0.001, output_dir=output_dir)
+        worker = Worker(profiler)
+        thread = Thread(target=worker.run)
+        thread.start()
+        worker.watching.wait()
+
+        try:
+            profiler.start(duration=0.05).join()
+        finally:
+            worker.done.set()
+            thread.join()
+
+        filenames = listdir(output_dir)
+        assert_that(filenames, has_length(1))
+        assert_that(filenames[0], starts_with("example-"))
+
+        with open(path.join(output_dir, filenames[0])) as profile:
+            roots = [line.split(";", 1)[0] for line in profile]
+
+    assert_that(roots, has_item("state: Worker.waiting"))
+
+
+def test_one_profile_at_a_time():
+    with TemporaryDirectory() as output_dir:
+        profiler = SamplingProfiler("example", interval=0.001, output_dir=output_dir)
+        thread = profiler.start(duration=0.05)
+        assert_that(profiler.start(), is_(none()))
+        thread.join()
+
+
+def test_signal_worker():
+    """
+    Workers are signalled by slot.
+
+    """
+    registry = WorkerRegistry(1, 2)
+    registry.record(100, slot=0)
+
+    with patch("microcosm_daemon.worker_registry.kill") as mock_kill:
+        assert_that(registry.signal_worker(0, PROFILE_SIGNAL), is_(equal_to(True)))
+        assert_that(registry.signal_worker(1, PROFILE_SIGNAL), is_(equal_to(False)))
+
+    mock_kill.assert_called_once_with(100, PROFILE_SIGNAL)
+
+
+def test_signal_exited_worker():
+    registry = WorkerRegistry(1, 2)
+    registry.record(100, slot=0)
+
+    with patch("microcosm_daemon.worker_registry.kill", side_effect=ProcessLookupError):
+        assert_that(registry.signal_worker(0, PROFILE_SIGNAL), is_(equal_to(False)))
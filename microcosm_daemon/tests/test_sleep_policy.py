@@ -2,11 +2,31 @@
 Sleep policy tests.
 
 """
-from unittest.mock import patch
+from asyncio import new_event_loop
+from copy import copy
+from os import pipe, write
+from threading import Barrier, Thread, Timer
+from time import perf_counter
+from unittest.mock import call, patch
 
-from hamcrest import assert_that, equal_to, is_
+from hamcrest import (
+    assert_that,
+    equal_to,
+    greater_than_or_equal_to,
+    is_,
+    less_than,
+    less_than_or_equal_to,
+    not_,
+)
 
-from microcosm_daemon.sleep_policy import SleepNow, SleepPolicy
+from microcosm_daemon.signal_handler import SignalHandler
+from microcosm_daemon.sleep_policy import (
+    AdaptiveSleepPolicy,
+    SleepNow,
+    SleepPolicy,
+    WaitFor,
+)
+from microcosm_daemon.wake_up import WakeUpPipe
 
 
 def test_no_sleep():
@@ -50,3 +70,219 @@ def test_sleep_now_custom_timeout():
 
     assert_that(mocked_sleep.call_count, is_(equal_to(1)))
     mocked_sleep.assert_called_with(0.2)
+
+
+def test_adaptive_backoff():
+    """
+    Consecutive sleeps back off exponentially up to a cap and reset on a productive step.
+
+    """
+    sleep_policy = AdaptiveSleepPolicy(default_sleep_timeout=0.1, max_sleep_timeout=0.3, jitter=0.0)
+
+    with patch.object(sleep_policy, "sleep") as mocked_sleep:
+        for _ in range(3):
+            with sleep_policy:
+                raise SleepNow()
+        with sleep_policy:
+            pass
+        with sleep_policy:
+            raise SleepNow()
+
+    assert_that(
+        mocked_sleep.call_args_list,
+        is_(equal_to([call(0.1), call(0.2), call(0.3), call(0.1)])),
+    )
+
+
+def test_adaptive_backoff_stays_capped():
+    """
+    Backing off for a long time (e.g. idle overnight) stays at the cap, including jitter.
+
+    """
+    sleep_policy = AdaptiveSleepPolicy(default_sleep_timeout=0.5, max_sleep_timeout=30.0, jitter=0.1)
+
+    with patch.object(sleep_policy, "sleep") as mocked_sleep:
+        for _ in range(2000):
+            with sleep_policy:
+                raise SleepNow()
+
+    assert_that(mocked_sleep.call_count, is_(equal_to(2000)))
+    sleep_timeout, = mocked_sleep.call_args[0]
+    assert_that(sleep_timeout, is_(less_than_or_equal_to(30.0)))
+    assert_that(sleep_timeout, is_(greater_than_or_equal_to(27.0)))
+
+
+def test_adaptive_jitter():
+    """
+    Sleep timeouts are jittered.
+
+    """
+    sleep_policy = AdaptiveSleepPolicy(default_sleep_timeout=1.0, max_sleep_timeout=1.0, jitter=0.1)
+
+    with patch.object(sleep_policy, "sleep") as mocked_sleep:
+        with sleep_policy:
+            raise SleepNow()
+
+    sleep_timeout, = mocked_sleep.call_args[0]
+    assert_that(abs(sleep_timeout - 1.0), is_(less_than(0.1 + 1e-9)))
+
+
+def test_adaptive_wake_up():
+    """
+    A wake-up ends a sleep early and resets the backoff.
+
+    """
+    sleep_policy = AdaptiveSleepPolicy(default_sleep_timeout=5.0, max_sleep_timeout=5.0, jitter=0.0)
+    sleep_policy.consecutive_sleeps = 3
+    Timer(0.05, sleep_policy.wake_up).start()
+
+    start = perf_counter()
+    sleep_policy.sleep(5.0)
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+    assert_that(sleep_policy.consecutive_sleeps, is_(equal_to(0)))
+
+
+def test_shutdown_ends_sleep():
+    """
+    Interrupting the daemon ends the current and subsequent sleeps.
+
+    """
+    signal_handler = SignalHandler()
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0, shutdown=signal_handler.shutdown)
+    Timer(0.05, signal_handler.interrupt).start()
+
+    start = perf_counter()
+    sleep_policy.sleep(5.0)
+    sleep_policy.sleep(5.0)
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+
+
+def test_shutdown_ends_async_sleep():
+    """
+    Interrupting the daemon ends an async sleep.
+
+    """
+    signal_handler = SignalHandler()
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0, shutdown=signal_handler.shutdown)
+    loop = new_event_loop()
+    loop.call_later(0.05, signal_handler.interrupt)
+
+    start = perf_counter()
+    try:
+        loop.run_until_complete(sleep_policy.async_sleep(5.0))
+    finally:
+        loop.close()
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+
+
+def test_wait_for_ready():
+    """
+    Waiting ends as soon as a file object is readable.
+
+    """
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0)
+    reader, writer = pipe()
+    Timer(0.05, write, (writer, b"x")).start()
+
+    start = perf_counter()
+    with sleep_policy:
+        raise WaitFor(reader)
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+    assert_that(sleep_policy.sleeps, is_(equal_to(1)))
+    # file objects are only registered while waiting
+    assert_that(len(sleep_policy.selector.get_map()), is_(equal_to(0)))
+
+
+def test_wait_for_timeout():
+    """
+    Waiting ends after the sleep timeout if nothing is ready.
+
+    """
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0)
+    reader, _ = pipe()
+
+    start = perf_counter()
+    with sleep_policy:
+        raise WaitFor([reader], sleep_timeout=0.05)
+
+    assert_that(perf_counter() - start, is_(greater_than_or_equal_to(0.05)))
+
+
+def test_wait_for_shutdown():
+    """
+    Interrupting the daemon ends a wait.
+
+    """
+    signal_handler = SignalHandler()
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0, shutdown=signal_handler.shutdown)
+    reader, _ = pipe()
+    Timer(0.05, signal_handler.interrupt).start()
+
+    start = perf_counter()
+    with sleep_policy:
+        raise WaitFor(reader)
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+
+
+def test_async_wait_for_ready():
+    """
+    Waiting without blocking the event loop ends as soon as a file object is readable.
+
+    """
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0)
+    reader, writer = pipe()
+    loop = new_event_loop()
+    loop.call_later(0.05, write, writer, b"x")
+
+    async def wait_for():
+        async with sleep_policy:
+            raise WaitFor(reader)
+
+    start = perf_counter()
+    try:
+        loop.run_until_complete(wait_for())
+    finally:
+        loop.close()
+
+    assert_that(perf_counter() - start, is_(less_than(1.0)))
+    assert_that(sleep_policy.sleeps, is_(equal_to(1)))
+
+
+def test_copy_uses_own_selector():
+    """
+    Copies of a sleep policy do not share a selector.
+
+    """
+    sleep_policy = SleepPolicy(default_sleep_timeout=5.0)
+    sleep_policy.ensure_selector()
+
+    sleep_policy_copy = copy(sleep_policy)
+
+    assert_that(sleep_policy_copy.ensure_selector(), is_(not_(sleep_policy.selector)))
+
+
+def test_wake_up_pipe_shared_across_threads():
+    """
+    Threads that first use a wake-up pipe at once share one pipe.
+
+    """
+    wake_up_pipe = WakeUpPipe()
+    barrier = Barrier(8)
+    readers = []
+
+    def first_use():
+        barrier.wait()
+        readers.append(wake_up_pipe.fileno())
+
+    threads = [Thread(target=first_use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_that(set(readers), is_(equal_to({wake_up_pipe.fileno()})))
@@ -2,6 +2,7 @@
 State machine tests.
 
 """
+from copy import copy
 from unittest.mock import patch
 
 from hamcrest import (
@@ -114,3 +115,90 @@ def test_run_until_fatal_error():
 
     state_machine = StateMachine(graph, initial_state=func)
     state_machine.run()
+
+
+def test_step_with_own_policies():
+    """
+    Per state machine policies are used instead of the graph's.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    sleep_policy = copy(graph.sleep_policy)
+
+    def func(graph):
+        raise SleepNow()
+
+    state_machine = StateMachine(graph, initial_state=func, sleep_policy=sleep_policy)
+    with patch.object(graph.sleep_policy, "sleep") as mocked_graph_sleep:
+        with patch.object(sleep_policy, "sleep") as mocked_sleep:
+            state_machine.step()
+
+    assert_that(mocked_graph_sleep.call_count, is_(equal_to(0)))
+    assert_that(mocked_sleep.call_count, is_(equal_to(1)))
+
+
+def test_advance_batch():
+    """
+    Batched advancing takes several steps within one policy scope.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    calls = []
+
+    def func1(graph):
+        calls.append(func1)
+        return func2
+
+    def func2(graph):
+        calls.append(func2)
+        return func1
+
+    state_machine = StateMachine(graph, initial_state=func1, batch_size=3)
+    with patch.object(graph.error_policy, "maybe_report_health") as mocked_report_health:
+        next_func = state_machine.advance()
+
+    assert_that(calls, is_(equal_to([func1, func2, func1])))
+    assert_that(next_func, is_(equal_to(func2)))
+    assert_that(mocked_report_health.call_count, is_(equal_to(1)))
+
+
+def test_advance_batch_until_sleep():
+    """
+    A batch ends when a state sleeps, which remains the current state.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    calls = []
+
+    def func1(graph):
+        calls.append(func1)
+        return func2
+
+    def func2(graph):
+        calls.append(func2)
+        raise SleepNow()
+
+    state_machine = StateMachine(graph, initial_state=func1, batch_size=10)
+    with patch.object(graph.sleep_policy, "sleep") as mocked_sleep:
+        next_func = state_machine.advance()
+
+    assert_that(calls, is_(equal_to([func1, func2])))
+    assert_that(next_func, is_(equal_to(func2)))
+    assert_that(mocked_sleep.call_count, is_(equal_to(1)))
+
+
+def test_advance_batch_time_budget():
+    """
+    A batch ends once its time budget elapses.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    calls = []
+
+    def func(graph):
+        calls.append(func)
+
+    state_machine = StateMachine(graph, initial_state=func, batch_size=100, batch_time_budget=0.0)
+    state_machine.advance()
+
+    assert_that(len(calls), is_(equal_to(1)))
@@ -0,0 +1,151 @@
+"""
+State metrics tests.
+
+"""
+from socket import AF_INET, SOCK_DGRAM, socket
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    contains_string,
+    equal_to,
+    is_,
+)
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.heartbeat import claim_heartbeat_slot
+from microcosm_daemon.sleep_policy import SleepNow
+from microcosm_daemon.standby import StandByGuard
+from microcosm_daemon.state_machine import StateMachine
+from microcosm_daemon.state_metrics import StateMetrics, StatsdExporter
+
+
+def test_record():
+    """
+    Steps are counted per state, with errors by type and sleeps.
+
+    """
+    metrics = StateMetrics(buckets=(0.1, 1.0))
+
+    def func(graph):
+        pass
+
+    metrics.record(func, 0.05, 0.01)
+    metrics.record(func, 0.5, 0.01, ValueError)
+    metrics.record(func, 2.0, 0.01, SleepNow, sleep_time=0.5)
+
+    stats = metrics.states["test_record.<locals>.func"]
+    assert_that(stats.calls, is_(equal_to(3)))
+    assert_that(stats.errors, is_(equal_to(dict(ValueError=1))))
+    assert_that(stats.sleeps, is_(equal_to(1)))
+    assert_that(stats.sleep_time, is_(equal_to(0.5)))
+    assert_that(stats.wall_time.counts, is_(equal_to([1, 1, 1])))
+    assert_that(stats.cpu_time.counts, is_(equal_to([3, 0, 0])))
+
+
+def test_state_machine_records_metrics():
+    """
+    The state machine records each step of each state.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    metrics = StateMetrics()
+
+    def func1(graph):
+        return func2
+
+    def func2(graph):
+        raise SleepNow()
+
+    state_machine = StateMachine(graph, initial_state=func1, metrics=metrics)
+    with patch.object(graph.sleep_policy, "sleep"):
+        state_machine.advance()
+        state_machine.advance()
+        state_machine.advance()
+
+    assert_that(
+        {name.split(".")[-1]: stats.calls for name, stats in metrics.states.items()},
+        is_(equal_to(dict(func1=1, func2=2))),
+    )
+    assert_that(metrics.states["test_state_machine_records_metrics.<locals>.func2"].sleeps, is_(equal_to(2)))
+
+
+def test_export():
+    metrics = StateMetrics(prefix="test", buckets=(0.1,))
+    metrics.record("first", 0.05, 0.01, KeyError)
+
+    assert_that(
+        metrics.to_prometheus(),
+        contains_string('test_state_wall_seconds_bucket{state="first",le="0.1"} 1'),
+    )
+    assert_that(
+        metrics.to_prometheus(),
+        contains_string('test_state_errors_total{state="first",error="KeyError"} 1'),
+    )
+    assert_that(metrics.to_statsd()[0], is_(equal_to("test.state.first.calls:1|g")))
+
+
+def test_record_wrapped_state():
+    """
+    Wrapping states (created anew for each step) are recorded as the wrapped state.
+
+    """
+    metrics = StateMetrics()
+
+    def func(graph):
+        pass
+
+    for _ in range(3):
+        metrics.record(StandByGuard(func, None, 1.0), 0.01, 0.01)
+
+    assert_that(list(metrics.states), is_(equal_to(["test_record_wrapped_state.<locals>.func"])))
+    assert_that(metrics.states["test_record_wrapped_state.<locals>.func"].calls, is_(equal_to(3)))
+
+
+def test_batched_state_machine_records_metrics():
+    """
+    Batched steps are recorded individually; the step that raised is charged the sleep.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    metrics = StateMetrics()
+    calls = []
+
+    def func(graph):
+        calls.append(None)
+        if len(calls) == 3:
+            raise SleepNow()
+
+    state_machine = StateMachine(graph, initial_state=func, batch_size=5, metrics=metrics)
+    with patch.object(graph.sleep_policy, "sleep"):
+        state_machine.advance()
+
+    stats = metrics.states["test_batched_state_machine_records_metrics.<locals>.func"]
+    assert_that(stats.calls, is_(equal_to(3)))
+    assert_that(stats.sleeps, is_(equal_to(1)))
+
+
+def test_statsd_exporter():
+    """
+    Metrics are pushed once the export interval elapses, scoped to the worker slot.
+
+    """
+    server = socket(AF_INET, SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(1.0)
+    metrics = StateMetrics(
+        prefix="test",
+        exporter=StatsdExporter(*server.getsockname()),
+        export_interval=60.0,
+    )
+    metrics.record("first", 0.05, 0.01)
+
+    claim_heartbeat_slot(2)
+    try:
+        metrics.maybe_export(now=metrics.next_export_time)
+        datagram = server.recv(65536)
+    finally:
+        claim_heartbeat_slot(None)
+        server.close()
+
+    assert_that(datagram.decode().split("\n")[0], is_(equal_to("test.worker.2.state.first.calls:1|g")))
@@ -0,0 +1,97 @@
+"""
+Standard library healthcheck server tests.
+
+"""
+from threading import Thread
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    equal_to,
+    has_length,
+    is_,
+)
+from requests import get, post
+
+from microcosm_daemon.heartbeat import HeartbeatTable
+from microcosm_daemon.runner import ProcessRunner
+from microcosm_daemon.stdlib_healthcheck_server import create_server, run
+from microcosm_daemon.worker_registry import WorkerRegistry
+
+
+def serve(server):
+    Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return f"http://{host}:{port}"
+
+
+def test_health_and_heartbeat():
+    """
+    The health endpoint reflects heartbeats posted to the heartbeat endpoint.
+
+    """
+    registry = WorkerRegistry(1, 2, cache_seconds=0.0)
+    server = create_server(1, 2, "127.0.0.1", 0, registry=registry)
+    url = serve(server)
+
+    try:
+        assert_that(get(f"{url}/api/health").status_code, is_(equal_to(500)))
+
+        assert_that(post(f"{url}/api/heartbeat", json=dict(pid=100, slot=0)).status_code, is_(equal_to(201)))
+        response = get(f"{url}/api/health")
+        assert_that(response.status_code, is_(equal_to(200)))
+        assert_that(response.json(), is_(equal_to(dict(heartbeats={"100": 0}))))
+
+        workers = get(f"{url}/api/workers").json()["workers"]
+        assert_that(workers, has_length(1))
+        assert_that(workers[0]["slot"], is_(equal_to(0)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_reads_table():
+    table = HeartbeatTable(1)
+    table.beat(0, pid=100)
+    server = create_server(1, 2, "127.0.0.1", 0, heartbeat_table=table)
+    url = serve(server)
+
+    try:
+        assert_that(get(f"{url}/api/health").status_code, is_(equal_to(200)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bad_requests():
+    server = create_server(1, 2, "127.0.0.1", 0)
+    url = serve(server)
+
+    try:
+        assert_that(post(f"{url}/api/heartbeat", data="not json").status_code, is_(equal_to(400)))
+        assert_that(post(f"{url}/api/heartbeat", json=dict(pid=0)).status_code, is_(equal_to(400)))
+        assert_that(get(f"{url}/api/unknown").status_code, is_(equal_to(404)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_process_runner_selects_backend():
+    runner = ProcessRunner(None, 1, heartbeat_threshold_seconds=2, healthcheck_backend="stdlib")
+    assert_that(runner.healthcheck_server, is_(equal_to(run)))
+
+
+def test_profile_endpoint():
+    registry = WorkerRegistry(1, 2)
+    registry.record(100, slot=0)
+    server = create_server(1, 2, "127.0.0.1", 0, registry=registry)
+    url = serve(server)
+
+    try:
+        with patch("microcosm_daemon.worker_registry.kill") as mock_kill:
+            assert_that(post(f"{url}/api/workers/0/profile").status_code, is_(equal_to(202)))
+            assert_that(post(f"{url}/api/workers/1/profile").status_code, is_(equal_to(404)))
+        assert_that(mock_kill.call_count, is_(equal_to(1)))
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,124 @@
+"""
+Work queue tests.
+
+"""
+from threading import Event
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    instance_of,
+    is_,
+    raises,
+)
+from microcosm.api import create_object_graph
+
+from microcosm_daemon.sleep_policy import WaitFor
+from microcosm_daemon.state_machine import StateMachine
+from microcosm_daemon.work_queue import WorkQueue
+
+
+def double(value):
+    return value * 2
+
+
+def fail():
+    raise Exception("failed")
+
+
+def test_submit():
+    work_queue = WorkQueue(max_size=2, workers=2)
+    try:
+        future = work_queue.submit(double, 21)
+        assert_that(future.result(), is_(equal_to(42)))
+    finally:
+        work_queue.close()
+
+    assert_that(work_queue.pending, is_(equal_to(0)))
+
+
+def test_submit_waits_when_full():
+    """
+    A full queue makes the producer wait on completion of pending items.
+
+    """
+    work_queue = WorkQueue(max_size=1, workers=1)
+    release = Event()
+    try:
+        work_queue.submit(release.wait)
+        assert_that(work_queue.capacity(), is_(equal_to(0)))
+        assert_that(calling(work_queue.submit).with_args(double, 1), raises(WaitFor))
+        assert_that(calling(work_queue.ensure_capacity), raises(WaitFor))
+
+        try:
+            work_queue.ensure_capacity()
+        except WaitFor as wait_for:
+            assert_that(wait_for.fileobjs, is_(equal_to([work_queue.completed])))
+
+        release.set()
+    finally:
+        work_queue.close()
+
+    assert_that(work_queue.capacity(), is_(equal_to(1)))
+    work_queue.ensure_capacity()
+
+
+def test_failures_are_counted():
+    work_queue = WorkQueue(max_size=1, workers=1)
+    try:
+        future = work_queue.submit(fail)
+        assert_that(future.exception(), is_(instance_of(Exception)))
+    finally:
+        work_queue.close()
+
+    assert_that(work_queue.failures, is_(equal_to(1)))
+    assert_that(work_queue.pending, is_(equal_to(0)))
+
+
+def test_producer_state():
+    """
+    A producer state hands items off and sleeps (rather than fails) while the queue is full.
+
+    """
+    graph = create_object_graph("example", testing=True)
+    work_queue = WorkQueue(max_size=1, workers=1)
+    release = Event()
+    submitted = []
+
+    def produce(graph):
+        work_queue.submit(release.wait)
+        submitted.append(True)
+
+    state_machine = StateMachine(graph, produce)
+    graph.sleep_policy.default_sleep_timeout = 0.01
+    try:
+        state_machine.advance()
+        state_machine.advance()
+        release.set()
+    finally:
+        work_queue.close()
+
+    assert_that(submitted, is_(equal_to([True])))
+    assert_that(graph.error_policy.errors, is_(equal_to([])))
+
+
+def test_process_queue_requires_non_daemonic_process():
+    """
+    A process work queue fails at startup (not on every submit) in a daemonic worker.
+
+    """
+    with patch("microcosm_daemon.work_queue.current_process") as mocked_current_process:
+        mocked_current_process.return_value.daemon = True
+        assert_that(calling(WorkQueue).with_args(processes=True), raises(ValueError, "--supervise"))
+        # thread pools are fine
+        WorkQueue()
+
+
+def test_process_queue():
+    work_queue = WorkQueue(max_size=2, workers=1, processes=True)
+    try:
+        assert_that(work_queue.submit(double, 21).result(), is_(equal_to(42)))
+    finally:
+        work_queue.close()
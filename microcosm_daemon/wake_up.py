@@ -0,0 +1,82 @@
+"""
+Wake-up pipes for interruptible sleeps.
+
+"""
+from os import (
+    close,
+    getpid,
+    pipe,
+    read,
+    set_blocking,
+    write,
+)
+from threading import RLock
+
+
+class WakeUpPipe:
+    """
+    A per-process self-pipe that ends sleeps waiting on it.
+
+    Setting the pipe only writes a byte, which is safe from signal handlers and other
+    threads (unlike `threading.Event.set`). The pipe is (re-)created lazily in each
+    process so that forked workers do not share it.
+
+    """
+    def __init__(self):
+        self.owner_pid = None
+        self.reader = None
+        self.writer = None
+        # reentrant, because signal handlers may set the pipe while it is being created
+        self.lock = RLock()
+
+    def ensure_pipe(self):
+        if self.owner_pid == getpid():
+            return
+
+        # threads (e.g. thread runner lanes) that sleep at once must share one pipe
+        with self.lock:
+            if self.owner_pid == getpid():
+                return
+
+            reader, writer = pipe()
+            set_blocking(reader, False)
+            set_blocking(writer, False)
+            if self.owner_pid == getpid():
+                # a signal handler created the pipe in the meantime
+                close(reader)
+                close(writer)
+                return
+
+            self.reader, self.writer = reader, writer
+            # publish the pipe only once it is usable
+            self.owner_pid = getpid()
+
+    def fileno(self):
+        """
+        The readable end of the pipe (to wait on).
+
+        """
+        self.ensure_pipe()
+        return self.reader
+
+    def writer_fileno(self):
+        """
+        The writable end of the pipe (for external wake-ups).
+
+        """
+        self.ensure_pipe()
+        return self.writer
+
+    def set(self):
+        try:
+            write(self.writer_fileno(), b"\0")
+        except BlockingIOError:
+            # the pipe is full, so a wake-up is already pending
+            pass
+
+    def clear(self):
+        try:
+            while read(self.fileno(), 4096):
+                pass
+        except BlockingIOError:
+            pass
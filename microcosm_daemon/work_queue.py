@@ -0,0 +1,167 @@
+"""
+Bounded work queue for handing work off from state functions.
+
+"""
+from logging import getLogger
+from multiprocessing import current_process
+from os import getpid
+from threading import Lock
+
+from microcosm.api import defaults
+from microcosm.config.types import boolean
+from microcosm.config.validation import typed
+
+from microcosm_daemon.sleep_policy import WaitFor
+from microcosm_daemon.wake_up import WakeUpPipe
+
+
+logger = getLogger("daemon.work_queue")
+
+
+class WorkQueue:
+    """
+    Hand work items off to a pool of threads (or processes) with backpressure.
+
+    A producer state submits items and moves on, so that fetching the next batch overlaps
+    with processing the last one:
+
+        def fetch(graph):
+            for message in graph.consumer.fetch(graph.work_queue.capacity()):
+                graph.work_queue.submit(handle, message)
+
+    At most `max_size` items are pending (queued or in progress) at once. Beyond that,
+    `submit` (and `ensure_capacity`) raise `WaitFor`, so that the producer state sleeps
+    until an item completes (or the sleep timeout expires) and is then retried. Idle
+    workers take the oldest pending item from the pool's shared queue.
+
+    With `processes`, items run in a process pool: handlers and items must be picklable.
+    Daemonic processes (e.g. the pool workers of an unsupervised `ProcessRunner`) may not
+    have children, so a process work queue cannot be created in one; `Daemon` runs its
+    workers under a supervisor instead.
+
+    The pool is created on first use in each process, so that forked workers do not
+    share it. Items that raise are logged and counted in `failures`.
+
+    """
+    def __init__(self, max_size=100, workers=4, processes=False):
+        if processes and current_process().daemon:
+            raise ValueError(
+                "work_queue.processes requires non-daemonic workers; "
+                "run multi-process daemons with --supervise",
+            )
+
+        self.max_size = max_size
+        self.workers = workers
+        self.processes = processes
+        self.executor = None
+        self.executor_pid = None
+        self.lock = Lock()
+        self.pending = 0
+        self.failures = 0
+        # set whenever an item completes, to end producer sleeps early
+        self.completed = WakeUpPipe()
+
+    def ensure_executor(self):
+        if self.executor_pid != getpid():
+            # avoid importing (slow) concurrent.futures for daemons that never submit work
+            if self.processes:
+                from concurrent.futures import ProcessPoolExecutor as Executor
+            else:
+                from concurrent.futures import ThreadPoolExecutor as Executor
+
+            self.executor_pid = getpid()
+            self.executor = Executor(max_workers=self.workers)
+            self.pending = 0
+        return self.executor
+
+    def capacity(self):
+        """
+        The number of items that may be submitted without waiting.
+
+        """
+        return max(self.max_size - self.pending, 0)
+
+    def ensure_capacity(self, count=1):
+        """
+        Wait (by raising `WaitFor`) unless `count` items may be submitted.
+
+        Producers may call this before fetching work, so that they never hold on to
+        items that the queue cannot take.
+
+        """
+        count = min(count, self.max_size)
+        if self.capacity() >= count:
+            return
+
+        self.completed.clear()
+        # an item may have completed before the wake-up pipe was cleared
+        if self.capacity() < count:
+            raise WaitFor(self.completed)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Submit an item: a call of `func(*args, **kwargs)`.
+
+        Returns a future for the item's result; raises `WaitFor` if the queue is full
+        (in which case the item is not submitted).
+
+        """
+        executor = self.ensure_executor()
+        with self.lock:
+            full = self.pending >= self.max_size
+            if not full:
+                self.pending += 1
+
+        if full:
+            self.ensure_capacity()
+            # an item completed in the meantime
+            return self.submit(func, *args, **kwargs)
+
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+        if not future.cancelled() and future.exception() is not None:
+            self.failures += 1
+            logger.warning(
+                "Work item failed: %s",
+                future.exception(),
+                exc_info=future.exception(),
+            )
+
+        self.completed.set()
+
+    def close(self, wait=True):
+        """
+        Shut the pool down, by default once pending items complete.
+
+        A later `submit` starts a new pool.
+
+        """
+        if self.executor is not None and self.executor_pid == getpid():
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+            self.executor_pid = None
+
+
+@defaults(
+    max_size=typed(int, 100),
+    workers=typed(int, 4),
+    processes=typed(boolean, False),
+)
+def configure_work_queue(graph):
+    return WorkQueue(
+        max_size=graph.config.work_queue.max_size,
+        workers=graph.config.work_queue.workers,
+        processes=graph.config.work_queue.processes,
+    )
@@ -0,0 +1,137 @@
+"""
+Worker registry for the healthcheck server.
+
+"""
+from logging import getLogger
+from os import kill
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional
+
+from microcosm_daemon.heartbeat import HeartbeatTable
+
+
+logger = getLogger("daemon.healthcheck_server")
+
+
+class WorkerRegistry:
+    """
+    Track worker heartbeats and decide whether the daemon is healthy.
+
+    Workers report through the shared-memory heartbeat table or over HTTP. Workers are
+    keyed by slot where known (by pid otherwise), so that a restarted worker replaces its
+    predecessor; HTTP heartbeats that are not renewed within `expiry_seconds` are
+    forgotten. Only workers reporting through the table describe their latest step
+    (state, latency) and idleness (steps, sleeps).
+
+    The daemon is healthy when at least `processes` workers have a heartbeat and none is
+    older than `heartbeat_threshold_seconds`. The verdict is recomputed at most once
+    every `cache_seconds`, so that frequent probes stay cheap.
+
+    """
+    def __init__(
+        self,
+        processes: int,
+        heartbeat_threshold_seconds: int,
+        heartbeat_table: Optional[HeartbeatTable] = None,
+        expiry_seconds: Optional[float] = None,
+        cache_seconds: float = 1.0,
+    ):
+        self.processes = processes
+        self.heartbeat_threshold_seconds = heartbeat_threshold_seconds
+        self.heartbeat_table = heartbeat_table
+        if expiry_seconds is None:
+            expiry_seconds = max(2.0 * heartbeat_threshold_seconds, 1.0)
+        self.expiry_seconds = expiry_seconds
+        self.cache_seconds = cache_seconds
+        # HTTP heartbeats: slot (or pid) -> worker
+        self.heartbeats: Dict[object, dict] = dict()
+        self.lock = Lock()
+        self.verdict = None
+        self.verdict_expiry = 0.0
+
+    def record(self, pid, slot=None, now=None):
+        """
+        Record an HTTP heartbeat.
+
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            self.heartbeats[pid if slot is None else ("slot", slot)] = dict(
+                slot=slot,
+                pid=pid,
+                timestamp=now,
+            )
+
+    def workers(self, now=None):
+        """
+        Describe each known worker, forgetting expired HTTP heartbeats.
+
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            for key, worker in list(self.heartbeats.items()):
+                if now - worker["timestamp"] > self.expiry_seconds:
+                    del self.heartbeats[key]
+            workers = [
+                dict(
+                    slot=worker["slot"],
+                    pid=worker["pid"],
+                    age=now - worker["timestamp"],
+                )
+                for worker in self.heartbeats.values()
+            ]
+
+        if self.heartbeat_table is not None:
+            workers.extend(self.heartbeat_table.workers())
+        return workers
+
+    def health(self, now=None):
+        """
+        Return the (cached) health verdict: a response body and status code.
+
+        """
+        now = monotonic() if now is None else now
+        verdict = self.verdict
+        if verdict is not None and now < self.verdict_expiry:
+            return verdict
+
+        workers = self.workers(now)
+        heartbeats = {
+            str(worker["pid"]): int(worker["age"])
+            for worker in workers
+        }
+        healthy = (
+            len(workers) >= self.processes and
+            all(worker["age"] <= self.heartbeat_threshold_seconds for worker in workers)
+        )
+        if not workers:
+            logger.warning("Daemon has no heartbeat. Healthcheck status: UNHEALTHY")
+            verdict = (dict(), 500)
+        else:
+            if not healthy:
+                logger.warning(
+                    "Healthcheck heartbeat status: UNHEALTHY.",
+                    extra=dict(heartbeat_values=heartbeats),
+                )
+            verdict = (dict(heartbeats=heartbeats), 200 if healthy else 500)
+
+        self.verdict = verdict
+        self.verdict_expiry = now + self.cache_seconds
+        return verdict
+
+    def signal_worker(self, slot, signalnum):
+        """
+        Send a signal to the worker in a slot (e.g. to start a profile).
+
+        Returns whether there was such a worker.
+
+        """
+        for worker in self.workers():
+            if worker["slot"] == slot:
+                try:
+                    kill(worker["pid"], signalnum)
+                except ProcessLookupError:
+                    return False
+                return True
+        return False
@@ -28,8 +28,11 @@ setup(
         "microcosm.factories": [
             "error_policy = microcosm_daemon.error_policy:configure_error_policy",
             "health_reporter = microcosm_daemon.health_reporter:configure_health_reporter",
+            "sampling_profiler = microcosm_daemon.sampling_profiler:configure_sampling_profiler",
             "signal_handler = microcosm_daemon.signal_handler:configure_signal_handler",
             "sleep_policy = microcosm_daemon.sleep_policy:configure_sleep_policy",
+            "state_metrics = microcosm_daemon.state_metrics:configure_state_metrics",
+            "work_queue = microcosm_daemon.work_queue:configure_work_queue",
         ]
     },
     extras_require={